@@ -0,0 +1,126 @@
+"""
+Benchmarks of the dices engine.
+
+Usage: python3 dice-bench.py [benchmark names...]
+Runs every benchmark when none is given.
+"""
+import itertools
+import resource
+import sys
+import time
+import timeit
+
+import numpy as np
+
+import dices
+from dices_commands import distribution
+
+
+def best_of(func, number: int = 20, repeat: int = 5) -> float:
+    """The best mean time (in seconds) of a call to func"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_convolution():
+    """Direct against FFT convolution of two probability arrays of the same length"""
+    print(f"{'length':>8} {'direct (µs)':>12} {'fft (µs)':>12}  fastest "
+          f"(current threshold: {distribution.FFT_THRESHOLD})")
+    threshold = distribution.FFT_THRESHOLD
+    try:
+        for length in [16, 32, 64, 128, 192, 256, 384, 512, 1024, 2048, 4096]:
+            a = np.full(length, 1 / length)
+            distribution.FFT_THRESHOLD = np.inf
+            direct = best_of(lambda: distribution.convolve(a, a))
+            distribution.FFT_THRESHOLD = 0
+            fft = best_of(lambda: distribution.convolve(a, a))
+            print(f"{length:>8} {direct * 1e6:>12.1f} {fft * 1e6:>12.1f}  {'fft' if fft < direct else 'direct'}")
+    finally:
+        distribution.FFT_THRESHOLD = threshold
+
+
+def rss_mib() -> float:
+    """The memory currently used by the process, the peak one where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def bench_graph(requests: int = 1000):
+    """Latency of consecutive graph requests, and the memory the process uses meanwhile"""
+    dices.set_verbose(False)
+    _, _, _, P = dices.decipher("d4*2d12")
+    start = rss_mib()
+    dices.warm_up()
+    print(f"{'requests':>8} {'mean (ms)':>10} {'p99 (ms)':>10} {'rss (MiB)':>10}  (before warm-up: {start:.1f} MiB)")
+    latencies = []
+    for request in range(1, requests + 1):
+        begin = time.perf_counter()
+        dices.render_figure(P, 29)
+        latencies.append(time.perf_counter() - begin)
+        if request % (requests // 10) == 0:
+            print(f"{request:>8} {np.mean(latencies) * 1e3:>10.1f} "
+                  f"{np.percentile(latencies, 99) * 1e3:>10.1f} {rss_mib():>10.1f}")
+
+
+def legacy_parse(i: list[str], parentheses_priority_offset=10) -> dices.Node:
+    """How trees were built before, adding every node to the root, which goes down the tree each time"""
+    base_priority = 0
+    cur_node = dices.Node.make(i[0])
+    for token in i[1:]:
+        if token in ("(", ")"):
+            base_priority += parentheses_priority_offset if token == "(" else -parentheses_priority_offset
+            continue
+        cur_node += dices.Node.make(token, base_priority)
+    return cur_node
+
+
+def bench_parse():
+    """Time to build the tree of generated instructions, up to 10k tokens"""
+    dices.set_verbose(False)
+    rng = np.random.default_rng(0)
+    print(f"{'tokens':>8} {'parse (ms)':>11} {'before (ms)':>12}")
+    for operands in [50, 500, 2500, 5000]:
+        dice = [f"{rng.integers(1, 10)}d{rng.choice([4, 6, 8, 10, 12, 20])}" for _ in range(operands)]
+        operations = rng.choice(["+", "-", "*", "/"], size=operands - 1)
+        instruction = " ".join(itertools.chain.from_iterable(zip(dice, operations))) + " " + dice[-1]
+        tokens = dices._segment(instruction)
+        parse = best_of(lambda: dices._parse(list(tokens)), number=5, repeat=3)
+        try:
+            before = f"{best_of(lambda: legacy_parse(list(tokens)), number=5, repeat=3) * 1e3:>12.2f}"
+        except RecursionError:
+            before = f"{'recursion':>12}"
+        print(f"{len(tokens):>8} {parse * 1e3:>11.2f} {before}")
+
+
+def bench_program(rolls: int = 100):
+    """Time per roll of an instruction, rolled one by one (Node.run), by the tree at once, or by its program"""
+    from dices_commands.node_actions import EvalContext, Program
+    dices.set_verbose(False)
+    context = EvalContext(verbose=False)
+    print(f"{'instruction':>24} {'run (µs)':>9} {'sample (µs)':>12} {'program (µs)':>13}  ({rolls} rolls)")
+    for instruction in ["2d6 + 3", "3 adv d20", "4d6 drop lowest", "10d10 > 6", "d6 adv (2d4 + d8) - 3",
+                        " + ".join(["d6"] * 300)]:
+        tree = dices._parse(dices._segment(instruction), context=context)
+        program = Program(tree)
+        tree.run(context)  # so that the distributions are not timed
+        run = best_of(lambda: [tree.run(context) for _ in range(rolls)], number=1, repeat=3)
+        sample = best_of(lambda: tree.sample(rolls, context), number=5, repeat=3)
+        flat = best_of(lambda: program.sample(rolls, context), number=5, repeat=3)
+        label = instruction if len(instruction) <= 24 else instruction[:21] + "..."
+        print(f"{label:>24} {run / rolls * 1e6:>9.2f} {sample / rolls * 1e6:>12.3f} {flat / rolls * 1e6:>13.3f}")
+
+
+BENCHMARKS = {
+    "convolution": bench_convolution,
+    "graph": bench_graph,
+    "parse": bench_parse,
+    "program": bench_program,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
@@ -1,5 +1,140 @@
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import random
+import tempfile
+import time
 import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
 import dices
+import tree_op
+from dices_commands import node_actions as nodes
+from dices_commands.cache import DiskCache, LRUCache, DISTRIBUTIONS
+from dices_commands.distribution import Distribution, SampledDistribution
+from dices_commands.node_actions import EvalContext
+from dices_commands.session import Session, SessionStore
+
+FIRST_CHARACTERS_OF_LONG_OPERATION_TOKENS = [token[0] for token in dices.OPERATION_TOKENS if len(token) > 1]
+
+
+def legacy_segment(i: str) -> list[str]:
+    """The tokenizer dices._segment replaced, kept to check that it gives the same tokens"""
+    els = []
+    cur = ""
+
+    def partially_fits(string: str) -> bool:
+        """Returns true if this string is a substring of any OPERATION TOKEN"""
+        return sum([string in token and string != token for token in dices.OPERATION_TOKENS]) != 0
+
+    for idx, char in enumerate(i):
+        if char in FIRST_CHARACTERS_OF_LONG_OPERATION_TOKENS:
+            if partially_fits(cur + char):
+                cur += char
+            elif idx + 1 < len(i):
+                if sum([char + i[idx + 1] in token for token in dices.OPERATION_TOKENS]) != 0:  # non exclusive partial fit
+                    if len(cur) > 0:
+                        els.append(cur)
+                    cur = char
+                elif cur + char in dices.OPERATION_TOKENS:
+                    els.append(cur + char)
+                    cur = ""
+                elif char in dices.OPERATION_TOKENS:
+                    if len(cur) > 0:
+                        els.append(cur)
+                    els.append(char)
+                    cur = ""
+                else:
+                    cur += char
+        elif char in dices.OPERATION_TOKENS or char == " ":
+            if len(cur) > 0:
+                els.append(cur)
+                cur = ""
+            # If you have a parentheses with no operator beforehand,
+            # then the operator is meant to be a multiplication sign (*)
+            if len(els) > 0:
+                if char == "(" and (els[-1] not in dices.OPERATION_TOKENS):
+                    els.append("*")
+            if char != " ":
+                els.append(char)
+                cur = ""
+        else:
+            # parentheses token
+            if len(els) > 0:
+                if els[-1] == ")":  # and char not in OPERATION_TOKEN (already verified due to being in the else close)
+                    # We have closed the parentheses with no operation on its right side.
+                    # By default, this means that the operator is a multiplication (*)
+                    els.append("*")
+                    # also, because we just added an element in els that is not ")",
+                    # the condition is no longer checked, and we won't have any issue
+            cur += char
+            if cur in dices.OPERATION_TOKENS:
+                if not partially_fits(cur):
+                    els.append(cur)
+                    cur = ""
+
+    if len(cur) > 0:
+        els.append(cur)
+    return els
+
+
+def random_instruction(rng: random.Random) -> str:
+    """An instruction made of random tokens, separated by random spaces (at least one between two words)"""
+    words = [
+        lambda: str(rng.randint(0, 100)),
+        lambda: f"{rng.choice(['', rng.randint(1, 20)])}d{rng.randint(1, 100)}",
+        lambda: rng.choice(["highest", "lowest"]) + rng.choice(["", str(rng.randint(1, 5))]),
+        lambda: rng.choice(tree_op.ADVANTAGE_TOKEN + tree_op.DISADVANTAGE_TOKEN + tree_op.EMPHASIS_TOKEN
+                           + tree_op.DROP_TOKEN + ["crit", "c"]),
+    ]
+    symbols = ["+", "-", "*", "/", "(", ")", "(", ")", "|", "#", "&", ">", "<", "<=", ">=", "=", "==", "!="]
+    comparisons = symbols[-7:]
+    # two comparisons side by side are ambiguous ("<==").
+    # the old tokenizer merged a lone "<", ">" or "=" with the word right after it
+    instruction, last_token, last_is_word = "", "", False
+    for _ in range(rng.randint(1, 12)):
+        if rng.random() < .6:
+            token, is_word = rng.choice(words)(), True
+        else:
+            token, is_word = rng.choice(symbols), False
+        spaces = rng.choice(["", "", " ", "  "])
+        if (is_word and last_is_word or last_token in ("<", ">", "=")
+                or token in comparisons and last_token in comparisons) and not spaces:
+            spaces = " "
+        instruction += spaces + token
+        last_token, last_is_word = token, is_word
+    # and dropped a comparison at the very end
+    return instruction + " " + words[0]()
+
+
+def legacy_parse(i: list[str], parentheses_priority_offset=10) -> dices.Node:
+    """How dices._parse built its trees, by adding the nodes one by one to the root, kept to check it still does"""
+    i = i[dices.consider_settings(i, EvalContext()):]
+    base_priority = 0
+    if len(i) == 0:
+        raise SyntaxError("empty command")
+    while i[0] in ("(", ")"):
+        if i.pop(0) == "(":
+            base_priority += parentheses_priority_offset
+        else:
+            base_priority -= parentheses_priority_offset
+    cur_node = dices.Node.make(i[0])
+    for token in i[1:]:
+        if token in ("(", ")"):
+            base_priority += parentheses_priority_offset if token == "(" else -parentheses_priority_offset
+            continue
+        cur_node += dices.Node.make(token, base_priority)
+    return cur_node
+
+
+def shape(tree: dices.Node | None) -> tuple | None:
+    if tree is None:
+        return None
+    return type(tree), tree.expression, tree.priority, shape(tree.left_child), shape(tree.right_child)
 
 
 class MyTestCase(unittest.TestCase):
@@ -10,8 +145,387 @@ class MyTestCase(unittest.TestCase):
                         "d20 + 3", "d20+ 3", "d20 +3", "d20+3",
                         "d20 > 14", "d20 >= 14", "d20>4", "d20>=20"]:
             dices.decipher(usecase)
+        rng = random.Random(0)
+        for instruction in [random_instruction(rng) for _ in range(5000)] + ["2(3+4)", "(1+2)3", "mind20"]:
+            self.assertEqual(dices._segment(instruction), legacy_segment(instruction), instruction)
+        # where the old tokenizer lost or merged tokens
+        self.assertEqual(dices._segment("d20 >4"), ["d20", ">", "4"])
+        self.assertEqual(dices._segment("2d6 + 3 >="), ["2d6", "+", "3", ">="])
+
+    def testParsing(self):
+        rng = random.Random(0)
+        for instruction in [random_instruction(rng) for _ in range(5000)] + ["2 * (3 + 4) - d6 adv 2", "(((1"]:
+            try:
+                expected = shape(legacy_parse(dices._segment(instruction)))
+            except Exception as e:
+                with self.assertRaises(type(e), msg=instruction), contextlib.redirect_stdout(io.StringIO()):
+                    dices._parse(dices._segment(instruction))
+            else:
+                self.assertEqual(shape(dices._parse(dices._segment(instruction))), expected, instruction)
+        # long chains are built without going down the tree
+        tokens = dices._segment(" + ".join(["d6"] * 5000))
+        self.assertEqual(len(tokens), 9999)
+        self.assertRaises(RecursionError, legacy_parse, tokens)
+        tree, additions = dices._parse(tokens), 0
+        while tree.right_child is not None:
+            tree, additions = tree.right_child, additions + 1
+        self.assertEqual(additions, 4999)
+
+    def testDistribution(self):
+        d6, d4 = Distribution.uniform(1, 6), Distribution.uniform(1, 4)
+        for result, operation in [(d6 + d4, lambda x, y: x + y),
+                                  (d6 - d4, lambda x, y: x - y),
+                                  (d6.combine(d4, lambda x, y: x * y), lambda x, y: x * y),
+                                  (d6.combine(d4, np.multiply), lambda x, y: x * y),
+                                  (d6.combine(d4, np.floor_divide), lambda x, y: x // y),
+                                  (d6.combine(d4, np.greater), lambda x, y: int(x > y))]:
+            expected = {}
+            for x, y in itertools.product(range(1, 7), range(1, 5)):
+                expected[operation(x, y)] = expected.get(operation(x, y), 0) + 1 / 24
+            self.assertEqual(sorted(result.keys()), sorted(expected.keys()))
+            for k in expected:
+                self.assertAlmostEqual(result[k], expected[k])
+        self.assertRaises(ZeroDivisionError, d6.combine, d6 - d4, np.floor_divide)
+
+    def testQuantiles(self):
+        d = Distribution.uniform(1, 6).power(3)
+        for P in [d, SampledDistribution.from_samples(np.random.default_rng(0).integers(0, 10 ** 6, 10 ** 4))]:
+            for value in [P.min - 1, P.min, (P.min + P.max) // 2, P.max - 1, P.max, P.max + 7]:
+                self.assertAlmostEqual(P.at_most(value), sum(p for k, p in P.items() if k <= value))
+                self.assertAlmostEqual(P.at_least(value), sum(p for k, p in P.items() if k >= value))
+            for q in [.05, .5, .95, 1.]:
+                x = P.quantile(q)
+                self.assertGreaterEqual(P.at_most(x), q - 1e-12)
+                self.assertLess(P.at_most(x - 1), q)
+        self.assertIs(d.cdf(), d.cdf())
+        self.assertEqual(dices.getF(d, 10), 1 / 2)
+        self.assertEqual(dices.stats_text(d), "p5 = 6, p25 = 8, p50 = 10, p75 = 13, p95 = 15 (expected 10.50)")
+
+    def testPower(self):
+        d20 = Distribution.uniform(1, 20)
+        for n in [0, 1, 2, 7, 200]:
+            expected = Distribution.constant(0)
+            for _ in range(n):
+                expected = expected + d20
+            result = d20.power(n)
+            self.assertEqual((result.min, result.max), (expected.min, expected.max))
+            self.assertTrue(abs(result.probs - expected.probs).max() < 1e-12)
+        best_of = lambda d1, d2: d1.combine(d2, max)
+        for k, p in best_of(best_of(d20, d20), d20).items():
+            self.assertAlmostEqual(d20.power(3, best_of)[k], p)
+
+    def testAdvantage(self):
+        d6, counts = Distribution.uniform(1, 6) + Distribution.uniform(1, 6), Distribution.uniform(1, 4)
+        for closed_form, pick in [(d6.max_of(counts), max), (d6.min_of(counts), min)]:
+            expected = Distribution.mixture(
+                (d6.power(n, lambda d1, d2: d1.combine(d2, pick)), p) for n, p in counts.items()
+            )
+            self.assertEqual((closed_form.min, closed_form.max), (expected.min, expected.max))
+            self.assertTrue(abs(closed_form.probs - expected.probs).max() < 1e-12)
+
+    def testPruning(self):
+        d = Distribution.uniform(1, 6).power(10)
+        for epsilon in [0., 1e-9, 1e-3, .1]:
+            pruned = d.prune(epsilon)
+            self.assertLessEqual(pruned.missing_mass, epsilon + 1e-12)
+            # no narrower interval of the support leaves out as little
+            width = pruned.max - pruned.min
+            best = max(d.probs[i:i + width].sum() for i in range(len(d.probs) - width + 1))
+            self.assertLess(best, 1 - epsilon - 1e-12)
+        self.assertIs(d.prune(0.), d)
+
+        exact = dices.decipher("40d20 + 40d20 + 40d20", EvalContext(verbose=False))[3]
+        pruned = dices.decipher("40d20 + 40d20 + 40d20", EvalContext(verbose=False, epsilon=1e-9))[3]
+        self.assertLess(pruned.max - pruned.min, (exact.max - exact.min) // 2)
+        self.assertLessEqual(pruned.missing_mass, 3e-9)
+        self.assertEqual(dices.describe_truncation(exact), "")
+        # a pruned session neither leaves out mass silently, nor changes what the others compute
+        pruned = dices.decipher("4d100 + 2 > 50", EvalContext(verbose=False, epsilon=.01))[3]
+        self.assertGreater(pruned.missing_mass, 0)
+        for instruction in ["4d100 + 2 > 50", "3 adv 2d10 + 5"]:
+            dices.decipher(instruction, EvalContext(verbose=False, epsilon=.01))
+            exact = dices.decipher(instruction, EvalContext(verbose=False))[3]
+            self.assertAlmostEqual(exact.missing_mass, 0)
+        self.assertAlmostEqual(dices.decipher("4d100 + 2 > 50", EvalContext(verbose=False))[3][4], .0731, places=4)
+        self.assertEqual(dices.read_epsilon(["prune", "off"]), 0.)
+        self.assertRaises(ValueError, dices.read_epsilon, ["prune", "2"])
+
+    def testCache(self):
+        cache = LRUCache(max_size=2)
+        for key in "abca":
+            cache.get_or_compute(key, lambda: key * 2)
+        self.assertEqual(cache.stats(), {"entries": 2, "bytes": 0, "hits": 0, "misses": 4, "evictions": 2})
+        self.assertEqual(cache.get("a"), "aa")
+        self.assertNotIn("b", cache)
+
+        hits = DISTRIBUTIONS.hits
+        dices.decipher("8d6 + 3")
+        dices.decipher("8d6 + 4")
+        self.assertIn(('dice', 8, 6), DISTRIBUTIONS)
+        self.assertGreater(DISTRIBUTIONS.hits, hits)
+
+        with tempfile.TemporaryDirectory() as directory:
+            LRUCache(max_size=1, backing=DiskCache(directory)).put(("png", "abc", 3), b"image")
+            cache = LRUCache(max_size=1, backing=DiskCache(directory))
+            self.assertEqual(cache.get(("png", "abc", 3)), b"image")
+            self.assertIn(("png", "abc", 3), cache)
+
+    def testDrop(self):
+        for number, size, removed in [(1, 6, 0), (2, 20, 1), (4, 6, 1), (4, 6, 2), (5, 4, 3), (3, 5, 3)]:
+            for lowest in (True, False):
+                expected = {}
+                for roll in itertools.product(range(1, size + 1), repeat=number):
+                    kept = sorted(roll, reverse=lowest)[:number - removed]
+                    expected[sum(kept)] = expected.get(sum(kept), 0) + size ** -number
+                result = tree_op.DropNode._drop_distribution(size, number, removed, lowest)
+                self.assertEqual(sorted(result.keys()), sorted(expected.keys()))
+                for k in expected:
+                    self.assertAlmostEqual(result[k], expected[k])
+
+    def testComparison(self):
+        node = tree_op.GTNode('>')
+        node.left_child, node.right_child = dices.nodes.DiceNode('4d10'), dices.nodes.ValueNode('6')
+        value, probas = node.run()
+        self.assertEqual(node.left_child.number, 4)
+        self.assertIn(value, range(5))
+        for successes in range(5):
+            expected = sum(
+                10 ** -4 for roll in itertools.product(range(1, 11), repeat=4)
+                if sum(die > 6 for die in roll) == successes
+            )
+            self.assertAlmostEqual(probas[successes], expected)
+
+    def testDispatch(self):
+        for expression, node_type in [
+            (">=", tree_op.GENode), (">", tree_op.GTNode), ("<=", tree_op.LENode), ("dadv", tree_op.DisadvantageNode),
+            ("d20", dices.nodes.DiceNode), ("12", dices.nodes.ValueNode), ("lowest2", tree_op.SuperlativeNode),
+        ]:
+            self.assertIs(type(dices.nodes.Node.make(expression)), node_type)
+        self.assertRaises(KeyError, dices.nodes.Node.make, "d")
+        self.assertEqual(dices.decipher("d20 >= 20")[1], 1)
+        self.assertEqual(dices.decipher("d20 >= 20")[3][1], .05)
+        self.assertEqual(dices.nodes.DiceNode('d20').number, 1)
+        self.assertIs(dices.nodes.parse_dice('3d6'), dices.nodes.parse_dice('3d6'))
+
+    def testRollMany(self):
+        for usecase in ["2d6 + 3", "3 adv d20", "dadv d20", "4d6 drop lowest", "10d10 > 6", "d4 * 2d12", "20d10 / 3"]:
+            _, maximum, expected, probas = dices.decipher(usecase)
+            rolls = dices.roll_many(usecase, 20000, seed=0)
+            self.assertEqual(rolls.shape, (20000,))
+            self.assertTrue(probas.min <= rolls.min() and rolls.max() <= maximum)
+            self.assertAlmostEqual(rolls.mean(), expected, delta=.05 * max(1., abs(expected)))
+        rolls, crits = dices.roll_many("crit d20 | 5d20", 20000, seed=0, criticals=True)
+        self.assertAlmostEqual(crits["failures"].mean(), 5 / 20, delta=.02)
+        self.assertAlmostEqual(crits["successes"].mean(), 5 / 20, delta=.02)
+
+    def testProgram(self):
+        for usecase in ["2d6 + 3", "3 adv d20", "d6 emph 3d6", "4d6 drop lowest", "10d10 > 6", "2 > 3d6",
+                        "d6 adv (2d4 + d8) - 3", "20d10 / 3"]:
+            rolls = []
+            for sample in [lambda tree: tree.sample, lambda tree: nodes.Program(tree).sample]:
+                crits = {"failures": np.zeros(100, dtype=np.int64), "successes": np.zeros(100, dtype=np.int64)}
+                context = EvalContext(criticals={"d6", "d10", "d20"}, rng=np.random.default_rng(1), verbose=False)
+                rolls.append((sample(dices._parse(dices._segment(usecase, context), context=context))(100, context, crits),
+                              crits))
+            (expected, expected_crits), (actual, actual_crits) = rolls
+            self.assertTrue((expected == actual).all(), usecase)
+            for kind in expected_crits:
+                self.assertTrue((expected_crits[kind] == actual_crits[kind]).all(), usecase)
+        # however deep the tree
+        tree = dices._parse(dices._segment(" + ".join(["d6"] * 5000)))
+        self.assertRaises(RecursionError, tree.sample, 10, EvalContext(verbose=False))
+        self.assertTrue((nodes.Program(tree).sample(10, EvalContext(verbose=False)) >= 5000).all())
+
+    def testMoments(self):
+        for usecase in ["2d6 + 3", "d4 * 2d12", "3d6 - 2d4 * 3", "(d6 + 2) * (d8 - 1)", "7"]:
+            plan = dices.compile_plan(usecase, context=EvalContext(verbose=False))
+            mean, variance = plan.moments
+            self.assertEqual(plan.maximum, plan.tree.bounds()[1])
+            _, maximum, expected, probas = dices.decipher(usecase)
+            self.assertEqual(plan.maximum, maximum)
+            self.assertAlmostEqual(mean, probas.mean())
+            self.assertAlmostEqual(variance, probas.variance())
+        self.assertIsNone(dices.compile_plan("3 adv d20", context=EvalContext(verbose=False)).moments)
+        # exact, even when the distribution is estimated
+        self.assertEqual(dices.decipher("30d30 * 30d30 * 30d30")[2], 465 ** 3)
+        # the divisor ranges over 0, 10 / 1 and 10 / -1 are the extremes
+        self.assertEqual(dices.compile_plan("10 / d4 - 2", context=EvalContext(verbose=False)).tree.bounds(), (-10, 10))
+
+    def testEstimation(self):
+        _, maximum, expected, probas = dices.decipher("30d30 * 30d30 * 30d30")
+        self.assertEqual(probas.mode, "sampled")
+        self.assertEqual(maximum, 900 ** 3)
+        low, high = probas.mean_interval(.999)
+        self.assertTrue(low <= 465 ** 3 <= high)
+        # the text graph groups the values into bins rather than spreading over all of them
+        self.assertLess(max(map(len, dices.show_P(probas, probas.min).splitlines())), 2 * dices.GRAPH_COLUMNS)
+        self.assertEqual(dices.decipher("30d30 * 30d30")[3].mode, "exact")
+        for pool in ["500d100", "1000d100", "40d20 drop highest10"]:
+            self.assertEqual(dices.decipher(pool, EvalContext(verbose=False))[3].mode, "exact")
+        costly = dices.compile_plan("20d1000 drop lowest10", context=EvalContext(verbose=False))
+        self.assertGreater(costly.tree.estimated_cost(), nodes.EXACT_BUDGET)
+
+    def testBatch(self):
+        lines = ["2d6 + 3\n", "\n", "d4 > 2", "1 +", "10d10 drop lowest"]
+        sequential, pooled = io.StringIO(), io.StringIO()
+        dices.batch(lines, sequential, distribution=True)
+        dices.batch(lines, pooled, workers=2, chunk_size=1)
+        results = [json.loads(line) for line in sequential.getvalue().splitlines()]
+        self.assertEqual([result["input"] for result in results], ["2d6 + 3", "d4 > 2", "1 +", "10d10 drop lowest"])
+        self.assertEqual(results[0]["max"], 15)
+        self.assertAlmostEqual(sum(results[1]["distribution"].values()), 1)
+        self.assertIn("error", results[2])
+        self.assertEqual(
+            [result.get("max") for result in results],
+            [json.loads(line).get("max") for line in pooled.getvalue().splitlines()]
+        )
+
+    def testDiscordExecutor(self):
+        for executor in [ThreadPoolExecutor(1), ProcessPoolExecutor(1)]:
+            with executor:
+                messages = []
+                session, other = Session(), Session()
+                asyncio.run(dices.discord_main("dnd", session))
+                answer = asyncio.run(dices.discord_main(
+                    "100d20", session, to_send_to=messages.append, executor=executor, timeout=30
+                ))
+                self.assertIn(f"**{session.value}**", answer)
+                self.assertEqual(session.distribution.max, 2000)
+                # the criticals of the session are known to the executor, and the messages come back
+                self.assertTrue(messages)
+                self.assertTrue(all("critical" in message for message in messages))
+                # but only for this session
+                messages.clear()
+                asyncio.run(dices.discord_main("100d20", other, to_send_to=messages.append, executor=executor))
+                self.assertEqual(messages, [])
+                asyncio.run(dices.discord_main("nocrit", session))
+                self.assertEqual(session.criticals, set())
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(time.sleep, .5)
+            answer = asyncio.run(dices.discord_main("2d6", session, executor=executor, timeout=.05))
+            self.assertTrue(answer.startswith("Gave up"))
+            self.assertEqual(session.distribution.max, 2000)
+
+    def testGraph(self):
+        class Channel:
+            def __init__(self):
+                self.files = []
+
+            async def send(self, file):
+                self.files.append(file)
+
+        _, _, _, P = dices.decipher("d4*2d12")
+        session = Session()
+        session.remember(29, P)
+        channel = Channel()
+        with ThreadPoolExecutor(1) as executor:
+            answer = asyncio.run(dices.discord_main("graph", session, channel=channel, executor=executor))
+        self.assertIn(dices.show_P(P, 29), answer)
+        self.assertEqual(dices.GRAPHS.get(("text", P.digest(), 29)), dices.show_P(P, 29))
+        self.assertEqual(len(channel.files), 1)
+        image = channel.files[0].fp.read()
+        self.assertTrue(image.startswith(b"\x89PNG"))
+
+        # the same distribution, computed again, is not drawn again
+        hits = dices.GRAPHS.hits
+        session.remember(29, dices.decipher("d4*2d12")[3])
+        asyncio.run(dices.discord_main("graph", session, channel=channel))
+        self.assertEqual(dices.GRAPHS.hits, hits + 2)
+        self.assertEqual(channel.files[1].fp.read(), image)
+
+    def testContext(self):
+        context = EvalContext(verbose=False)
+        dices.decipher("crit d20 | 2d20", context)
+        self.assertEqual(context.criticals, set())
+        dices.decipher("crit d20 & 2d20", context)
+        self.assertEqual(context.criticals, {"d20"})
+
+        def roll(critical: bool) -> list[str]:
+            messages = []
+            for _ in range(20):
+                dices.decipher("50d20", EvalContext(
+                    criticals={"d20"} if critical else set(), publisher=messages.append, verbose=False
+                ))
+            return messages
+
+        # evaluations running at once do not share their criticals
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(roll, [True, False] * 4))
+        self.assertTrue(all(results[::2]))
+        self.assertFalse(any(results[1::2]))
+
+        seeded = [dices.decipher("3 adv 10d20", EvalContext(rng=np.random.default_rng(3), verbose=False))
+                  for _ in range(2)]
+        self.assertEqual(seeded[0][0], seeded[1][0])
+
+    def testPlans(self):
+        dices.PLANS.clear()
+        stats = dices.PLANS.stats()
+        context = EvalContext(verbose=False)
+        rolls = [dices.decipher(instruction, context) for instruction in ["3d6 + 2"] * 300 + ["3d6  +2 ", " 3d6 + 2"]]
+        self.assertEqual(dices.PLANS.stats()["misses"] - stats["misses"], 2)
+        self.assertEqual(dices.PLANS.stats()["hits"] - stats["hits"], 300)
+        self.assertTrue(all(P is rolls[0][3] for _, _, _, P in rolls[:300] + rolls[-1:]))
+        self.assertLessEqual({v for v, _, _, _ in rolls}, set(range(5, 21)))
+        self.assertAlmostEqual(np.mean([v for v, _, _, _ in rolls]), 12.5, delta=.5)
+
+        # the settings of an instruction still apply when it is not compiled again
+        for _ in range(2):
+            context = EvalContext(verbose=False)
+            dices.decipher("crit d20 & d20 > 10", context)
+            self.assertEqual(context.criticals, {"d20"})
+
+        # a tree is frozen once compiled
+        tree = dices.PLANS.get(dices.plan_key("crit d20 & d20 > 10")).tree
+        self.assertIs(tree.first_die_child(), tree.left_child)
+        self.assertEqual(tree.count_dices_children(), 1)
+        # however deep the tree
+        tree = dices._parse(dices._segment(" + ".join(["d6"] * 3000), context), context=context)
+        tree.freeze()
+        self.assertEqual(tree.count_dices_children(), 3000)
+        self.assertIsNot(tree.clone().first_die_child(), tree.first_die_child())
+        self.assertEqual(tree.held_bytes(), 0)
+        deep = " + ".join(["d6"] * 3000)
+        self.assertIn(dices.roll(deep, context), range(3000, 18001))
+        mean, variance = dices.PLANS.get(dices.plan_key(deep)).moments
+        self.assertEqual(mean, 3000 * 3.5)
+        self.assertAlmostEqual(variance, 3000 * 35 / 12, places=6)
+
+        # the rolls do not change the shared tree, they run copies of it
+        plan = dices.get_plan("2d6 + 3d6", context, solved=True)
+        rolled = [node.last_value for node in (plan.tree, plan.tree.left_child, plan.tree.right_child)]
+        for _ in range(50):
+            plan.roll(context)
+        self.assertEqual([node.last_value for node in (plan.tree, plan.tree.left_child, plan.tree.right_child)], rolled)
+        clone = plan.tree.clone()
+        self.assertIsNot(clone.left_child, plan.tree.left_child)
+        self.assertIs(clone.left_child._probas, plan.tree.left_child._probas)
+
+        # rolling alone does not compute the distribution
+        for _ in range(20):
+            self.assertIn(dices.roll("1000d1000 * 1000d1000 + 3", context), range(10 ** 6 + 3, 10 ** 12 + 4))
+        self.assertFalse(dices.PLANS.get(dices.plan_key("1000d1000 * 1000d1000 + 3")).solved)
+        result = json.loads(dices.evaluate_line("2d6 + 3", roll_only=True))
+        self.assertEqual((result["max"], result["expected"]), (15, 10.))
+        self.assertFalse(dices.PLANS.get(dices.plan_key("2d6 + 3")).solved)
+        self.assertEqual(json.loads(dices.evaluate_line("3 adv d20", roll_only=True)).keys(), {"input", "value"})
+
+        estimated = [dices.decipher("30d30 * 30d30 * 30d30", context)[0] for _ in range(50)]
+        self.assertGreater(len(set(estimated)), 1)
+        self.assertTrue(all(30 ** 3 <= v <= 900 ** 3 for v in estimated))
+
+    def testSessions(self):
+        sessions = SessionStore(max_sessions=2, ttl=.1)
+        sessions.get("a").criticals.add("d20")
+        sessions.get("b")
+        self.assertEqual(sessions.get("a").criticals, {"d20"})
+        sessions.get("c")
+        self.assertNotIn("b", sessions)
+        time.sleep(.2)
+        self.assertNotIn("a", sessions)
+        self.assertEqual(sessions.get("a").criticals, set())
 
 
 if __name__ == '__main__':
-    dices.verbose = False
+    dices.set_verbose(False)
     unittest.main()
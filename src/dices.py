@@ -1,10 +1,25 @@
+import argparse
+import asyncio
+import dataclasses
+import io
+import itertools
+import json
+import re
 import readline
-from typing import Callable
+import sys
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, TextIO
 
 import discord
+import numpy as np
 
 import dices_commands.node_actions as nodes
+from dices_commands.node_actions import EvalContext
 import tree_op
+from dices_commands.cache import DiskCache, LRUCache
+from dices_commands.distribution import SampledDistribution
+from dices_commands.session import Session
 from tree_op import Node
 from dices_commands.utils import ansi_skipping_len
 import errors
@@ -14,82 +29,47 @@ OPERATION_TOKENS = ["+", "-", "*", "/", "(", ")", "|", "#", "&", ">", "<", "<=",
     tree_op.ADVANTAGE_TOKEN + tree_op.DISADVANTAGE_TOKEN + tree_op.DROP_TOKEN
 )
 
-FIRST_CHARACTERS_OF_LONG_OPERATION_TOKENS = [token[0] for token in OPERATION_TOKENS if len(token) > 1]
+SYMBOL_TOKENS = {token for token in OPERATION_TOKENS if not token[0].isalnum()}
+_OPERATION_PATTERN = "|".join(re.escape(token) for token in sorted(OPERATION_TOKENS, key=len, reverse=True))
+TOKENIZER = re.compile(f"{_OPERATION_PATTERN}|(?:(?!{_OPERATION_PATTERN})[^ ])+")
+"""
+The tokens of an instruction: the operations, the longest first, and what is between them and the spaces.
+"""
 
-CRITICAL_DICE_PERM = nodes.CRITICAL_DICE_PERM  # The dices that have a criticality
-CRITICAL_DICE_TMP = nodes.CRITICAL_DICE_TMP
 NUM_LINES = 8
+GRAPH_COLUMNS = 120
+"""The most columns a text graph spreads over, the values are grouped into bins past it"""
 INPUTS_THAT_ASK_FOR_GRAPH = ["graph", "draw", "g", "repartition", "see"]
+INPUTS_THAT_PRUNE = ["prune", "epsilon", "eps"]
+INPUTS_THAT_ASK_FOR_STATS = ["stats", "percentiles", "quantiles"]
+PERCENTILES = (5, 25, 50, 75, 95)
+GRAPHS = LRUCache(max_size=512, max_bytes=32 * 2 ** 20, sizeof=len)
+"""The graphs already drawn, images and texts, keyed by their kind, the digest of their distribution and the roll"""
 verbose = True
+"""Whether the evaluations print what they do, unless their context says otherwise"""
 
 
-def _segment(i: str) -> list[str]:
+def _segment(i: str, context: EvalContext = None) -> list[str]:
     """Segments an instruction into a series of tokens that are computationable"""
-    if verbose:
+    if (verbose if context is None else context.verbose):
         print("\033[34m" + "segmenting...\033[0m")
     els = []
-    cur = ""
-
-    def partially_fits(string: str) -> bool:
-        """Returns true if this string is a substring of any OPERATION TOKEN"""
-        return sum([string in token and string != token for token in OPERATION_TOKENS]) != 0
-
-    for idx, char in enumerate(i):
-        # print("--", f"'{char}'", cur, els,
-        #       char in OPERATION_TOKENS or char == " ",
-        #       char in FIRST_CHARACTERS_OF_LONG_OPERATION_TOKENS,
-        #       sep="\t\t")
-        if char in FIRST_CHARACTERS_OF_LONG_OPERATION_TOKENS:
-            if partially_fits(cur + char):
-                cur += char
-            elif idx + 1 < len(i):
-                if sum([char + i[idx + 1] in token for token in OPERATION_TOKENS]) != 0:  # non exclusive partial fit
-                    if len(cur) > 0:
-                        els.append(cur)
-                    cur = char
-                elif cur + char in OPERATION_TOKENS:
-                    els.append(cur + char)
-                    cur = ""
-                elif char in OPERATION_TOKENS:
-                    if len(cur) > 0:
-                        els.append(cur)
-                    els.append(char)
-                    cur = ""
-                else:
-                    cur += char
-        elif char in OPERATION_TOKENS or char == " ":
-            if len(cur) > 0:
-                els.append(cur)
-                cur = ""
-            # If you have a parentheses with no operator beforehand,
-            # then the operator is meant to be a multiplication sign (*)
-            if len(els) > 0:
-                if char == "(" and (els[-1] not in OPERATION_TOKENS):
-                    els.append("*")
-            if char != " ":
-                els.append(char)
-                cur = ""
-        else:
-            # parentheses token
-            if len(els) > 0:
-                if els[-1] == ")":  # and char not in OPERATION_TOKEN (already verified due to being in the else close)
-                    # We have closed the parentheses with no operation on its right side.
-                    # By default, this means that the operator is a multiplication (*)
-                    els.append("*")
-                    # also, because we just added an element in els that is not ")",
-                    # the condition is no longer checked, and we won't have any issue
-            cur += char
-            if cur in OPERATION_TOKENS:
-                if not partially_fits(cur):
-                    els.append(cur)
-                    cur = ""
-
-    if len(cur) > 0:
-        els.append(cur)
+    for match in TOKENIZER.finditer(i):
+        token = match.group()
+        if len(els) > 0:
+            if token == "(" and els[-1] not in OPERATION_TOKENS:
+                # If you have a parentheses with no operator beforehand,
+                # then the operator is meant to be a multiplication sign (*)
+                els.append("*")
+            elif els[-1] == ")" and token not in SYMBOL_TOKENS:
+                # We have closed the parentheses with no operation on its right side.
+                # By default, this means that the operator is a multiplication (*)
+                els.append("*")
+        els.append(token)
     return els
 
 
-def consider_settings(i: list[str]) -> int:
+def consider_settings(i: list[str], context: EvalContext) -> int:
     """Returns true if the token implement settings. Only the first tokens are considered as settings
 
     Both the pipe ('|') character and the hashtag ('#') mean that the setting is to be used only for this time.
@@ -101,18 +81,18 @@ def consider_settings(i: list[str]) -> int:
     then roll a d20.
     """
     # Most commands won't be setting up anything. Let's have them go
-    splitting_tokens = ["|", "#"]
+    splitting_tokens = ["|", "#", "&"]
     permanent_tokens = ["&"]
     c = False
-    global_parameter_to_set = []
+    global_parameter_to_set = set()
     for token in splitting_tokens:
         if token in i:
             c = True
             # setting up the permanence or no of the command
             if token in permanent_tokens:
-                global_parameter_to_set = CRITICAL_DICE_PERM
+                global_parameter_to_set = context.criticals
             else:
-                global_parameter_to_set = CRITICAL_DICE_TMP
+                global_parameter_to_set = context.temporary_criticals
             break
     if not c:
         return 0
@@ -124,7 +104,7 @@ def consider_settings(i: list[str]) -> int:
             # the next token must be a die (because otherwise we would have just set ourselves for a dnd mode
             NEXT_TOKEN = i[idx + 1]
             assert "d" in NEXT_TOKEN and NEXT_TOKEN[1:].isnumeric()
-            global_parameter_to_set.append(NEXT_TOKEN)
+            global_parameter_to_set.add(NEXT_TOKEN)
 
 
 def show_P(proba: dict[int, float], roll: int = None) -> str:
@@ -158,13 +138,22 @@ def show_P(proba: dict[int, float], roll: int = None) -> str:
             # print(lines[y][:start], lines[y][end+1:], start, end, lines[y], x, y, sep="\033[0m||", end="\033[0m\n")
             lines[_y] = lines[_y][:start] + char + lines[_y][end + 1:]
 
-    items, keys = proba.values(), sorted(proba.keys())
+    keys = sorted(proba.keys())
+    x_min = min(keys)
+    x_max = max(keys)
+    # one column per value, or per bin of consecutive values when there are too many of them
+    bin_width = -(-(x_max - x_min + 1) // GRAPH_COLUMNS)
+    columns: dict[int, float] = {}
+    for x in keys:
+        column = (x - x_min) // bin_width
+        columns[column] = columns.get(column, 0.) + proba[x]
+    items = columns.values()
     y_max = max(items)
     y_min = min(items)
     if abs(y_min) < 1.:
         y_min = 0
-    x_min = min(keys)
-    x_max = max(keys)
+    last_column = (x_max - x_min) // bin_width
+    tick = 5 if bin_width == 1 else max(5, len(str(x_max)) + 1)
     n_lines = NUM_LINES - (3 if roll is not None else 2)
 
     def scale(_y: float) -> int:
@@ -178,34 +167,32 @@ def show_P(proba: dict[int, float], roll: int = None) -> str:
     for l_nb in range(1, n_lines):
         lines[l_nb] = " " * n + "|\033[33;1m"
     n += 1
-    for x in sorted(proba.keys()):
-        precise_y = proba[x]
+    for column in sorted(columns):
+        precise_y = columns[column]
         for y in range(scale(precise_y)):
-            write_at("#", x + n - x_min, n_lines - 1 - y)
-    lines[n_lines] += "-" * (x_max - x_min + n) + "-->"
+            write_at("#", column + n, n_lines - 1 - y)
+    lines[n_lines] += "-" * (last_column + n) + "-->"
     lines[n_lines + 1] = "\033[36;1m" + " " * n
-    for step in range(x_min, x_max + 5, 5):
-        if step != x_min:
-            write_at("+", step + n - x_min, n_lines)
-        write_at(str(step), step + n - x_min, n_lines + 1)
+    for column in range(0, last_column + tick, tick):
+        if column != 0:
+            write_at("+", column + n, n_lines)
+        write_at(str(x_min + column * bin_width), column + n, n_lines + 1)
     # if there is a pointer, print it!
     if roll is not None:
-        lines[-1] = " " * (n + roll - x_min) + "\033[32;1m^\033[0m"
+        lines[-1] = " " * (n + (roll - x_min) // bin_width) + "\033[32;1m^\033[0m"
     return "\n".join(lines)
 
 
-def _decipher(
-        i: list[str],
-        parentheses_priority_offset=10,
-        add_msg_discord=None
-) -> tuple[int, int, float, dict[int, float]]:
-    """Renvoie une valeur aléatoire, la valeur maximale et la valeur moyenne à laquelle on pourrait s'attendre
+def _parse(i: list[str], parentheses_priority_offset=10, context: EvalContext = None) -> Node:
+    """Builds the tree of the operations of an instruction, without running it
     Operation order : (), *, /, +, -, dice
     Parentheses do not need to be closed
     Parentheses with no operation imply a multiplication (*) """
-    i = i[consider_settings(i):]
-    print("\033[34m" +
-          f"parsing\033[0m... \033[36m{len(i)}\033[0m token{'s' if len(i) > 1 else ''} found : \033[36m{i}\033[0m")
+    context = context or EvalContext(verbose=verbose)
+    i = i[consider_settings(i, context):]
+    if context.verbose:
+        print("\033[34m" +
+              f"parsing\033[0m... \033[36m{len(i)}\033[0m token{'s' if len(i) > 1 else ''} found : \033[36m{i}\033[0m")
     base_priority = 0
     if len(i) == 0:
         raise SyntaxError("empty command")
@@ -215,6 +202,10 @@ def _decipher(
         else:
             base_priority -= parentheses_priority_offset
     cur_node = Node.make(i[0])
+    # The right-most branch of the tree, from the root down.
+    # Going down it, the priorities of the operations never increase, so the node that a
+    # new one takes the place of is found by popping from the bottom, each node being popped once
+    branch = [cur_node]
     for token in i[1:]:
         if token in ("(", ")"):
             if token == "(":
@@ -223,28 +214,262 @@ def _decipher(
                 base_priority -= parentheses_priority_offset
             continue
         token_node = Node.make(token, base_priority)
-        try:
-            cur_node += token_node
-        except Exception as e:
+        replaced = None
+        while branch and (branch[-1].is_value or token_node.priority > branch[-1].priority):
+            replaced = branch.pop()
+        if replaced is None:
+            # an operation of higher or equal priority, that had no right side yet
+            branch[-1].right_child = token_node
+        elif replaced.is_value and token_node.is_value:
             print(cur_node)  # dump the data in the log for debugging purposes
-            raise e
-    print(cur_node)
-    return (
-        cur_node.run(add_msg_discord)[0],
-        max(cur_node.probas.keys()),
-        sum([
-            k * cur_node.probas[k]
-            for k in cur_node.probas
-        ]) if len(cur_node.probas) > 0 else 0,
-        cur_node.probas
+            raise Exception("Two side-by side values : {} and {}".format(replaced.expression, token_node.expression))
+        else:
+            token_node.left_child = replaced
+            if branch:
+                branch[-1].right_child = token_node
+            else:
+                cur_node = token_node
+        branch.append(token_node)
+    return cur_node
+
+
+@dataclasses.dataclass
+class Plan:
+    """
+    An instruction compiled once, to be rolled as many times as it is asked for.
+
+    Its tree is frozen (see Node.freeze), and lowered into a program.
+    Once its distribution is computed, the tree is only read: the rolls run copies of it (see Node.clone).
+    criticals and temporary_criticals are the dice the instruction itself makes critical,
+    for the whole session or for this roll only.
+    epsilon is the pruning of its distributions (see EvalContext).
+    Its distribution is only computed the first time it is asked for,
+    and its maximum and expected value along, unless they could be told from its moments.
+    """
+    tree: Node
+    criticals: frozenset[str]
+    temporary_criticals: frozenset[str]
+    program: nodes.Program
+    moments: nodes.Moments | None
+    """The mean and variance of the instruction, when they can be told without its distribution"""
+    epsilon: float = 0.
+    _solution: tuple[int, float, nodes.P_FIELD] | None = dataclasses.field(default=None, init=False, repr=False)
+    _lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def solved(self) -> bool:
+        """Whether the distribution was computed already"""
+        return self._solution is not None
+
+    def solve(self) -> tuple[int, float, nodes.P_FIELD]:
+        """The maximum, expected value and distribution of the instruction, computed the first time only"""
+        with self._lock:
+            if self._solution is None:
+                # the roll made along the distributions is not shown, and drawn apart,
+                # so that solving a plan does not change the rolls of a seeded context
+                quiet = EvalContext(rng=np.random.default_rng(0), verbose=False, epsilon=self.epsilon)
+                if self.tree.estimated_cost() > nodes.EXACT_BUDGET:
+                    _, maximum, mean, probas = _estimate(self.tree, quiet)
+                else:
+                    probas = self.tree.run(quiet)[1]
+                    maximum, mean = probas.max, probas.mean()
+                self._solution = maximum, mean, probas
+        return self._solution
+
+    @property
+    def maximum(self) -> int:
+        if self.moments is not None:
+            # the instruction is only made of sums, differences and products, whose bounds are reached
+            return self.tree.bounds()[1]
+        return self.solve()[0]
+
+    @property
+    def mean(self) -> float:
+        return self.moments[0] if self.moments is not None else self.solve()[1]
+
+    @property
+    def variance(self) -> float:
+        return self.moments[1] if self.moments is not None else self.solve()[2].variance()
+
+    @property
+    def probas(self) -> nodes.P_FIELD:
+        return self.solve()[2]
+
+    @property
+    def n_bytes(self) -> int:
+        return self.tree.held_bytes() + (self.probas.nbytes if self.solved else 0)
+
+    def roll(self, context: EvalContext, distribution: bool = True) -> int:
+        """
+        Rolls the instruction once, keeping its settings for the session in context.
+
+        Without distribution, the roll is sampled through the program, which does not need it
+        (the criticals are then announced as a count).
+        """
+        context.criticals.update(self.criticals)
+        context = dataclasses.replace(context, temporary_criticals=set(self.temporary_criticals))
+        if distribution and self.probas.mode != "sampled":
+            # the tree is shared by every roll of the plan, each of them runs its own copy
+            return self.tree.clone().run(context)[0]
+        crits = {"failures": np.zeros(1, dtype=np.int64), "successes": np.zeros(1, dtype=np.int64)}
+        value = int(self.program.sample(1, context, crits)[0])
+        _announce_criticals(crits, context)
+        return value
+
+
+PLANS = LRUCache(max_size=1024, max_bytes=64 * 2 ** 20, sizeof=lambda plan: plan.n_bytes)
+"""
+The instructions already compiled, keyed by their text and the pruning of their distributions (see plan_key).
+The criticals of the sessions are not part of a plan, which can be rolled by any of them:
+nothing is to be invalidated when they change, PLANS.clear() forgets everything otherwise.
+"""
+
+
+def plan_key(i: str, epsilon: float = 0.) -> tuple[str, float]:
+    """
+    The text of an instruction, where the spaces that do not change its tokens are ignored,
+    and the pruning of its distributions
+    """
+    return " ".join(i.split()), epsilon
+
+
+def compile_plan(i: str, parentheses_priority_offset=10, context: EvalContext = None) -> Plan:
+    """Parses an instruction, without computing its distribution nor rolling it"""
+    context = context or EvalContext(verbose=verbose)
+    settings = EvalContext(verbose=context.verbose)
+    tree = _parse(_segment(i, settings), parentheses_priority_offset, settings)
+    if settings.verbose:
+        print(tree)
+    tree.freeze()
+    return Plan(
+        tree, frozenset(settings.criticals), frozenset(settings.temporary_criticals),
+        nodes.Program(tree), tree.moments(), context.epsilon
     )
 
 
-def decipher(i: str, add_msg_discord=None) -> tuple[int, int, float, dict[int:float]]:
-    t: tuple = tuple(_decipher(_segment(i), add_msg_discord=add_msg_discord))
-    while len(CRITICAL_DICE_TMP) > 0:
-        CRITICAL_DICE_TMP.pop()  # we empty the temp list
-    return t
+def _estimate(tree: Node, context: EvalContext) -> tuple[int, int, float, SampledDistribution]:
+    """Rolls the tree MONTE_CARLO_SAMPLES times, to estimate its distribution"""
+    crits = {
+        "failures": np.zeros(nodes.MONTE_CARLO_SAMPLES, dtype=np.int64),
+        "successes": np.zeros(nodes.MONTE_CARLO_SAMPLES, dtype=np.int64),
+    }
+    rolls = nodes.Program(tree).sample(nodes.MONTE_CARLO_SAMPLES, context, crits)
+    # the first roll is the one that is shown, and whose criticals are announced
+    _announce_criticals(crits, context)
+    probas = SampledDistribution.from_samples(rolls)
+    return int(rolls[0]), tree.bounds()[1], probas.mean(), probas
+
+
+def _announce_criticals(crits: dict[str, np.ndarray], context: EvalContext) -> None:
+    """Announces the criticals counted for the first of the sampled rolls"""
+    for kind, color, name, outcome in [("failures", 31, "NATURAL 1", "failure"),
+                                       ("successes", 32, "NATURAL MAXIMUM", "success")]:
+        if crits[kind][0] > 0:
+            context.announce(
+                f"\033[33m{crits[kind][0]} dice rolled a \033[{color};1m{name}\033[33m "
+                f"(critical {outcome})\033[0m",
+                f"{crits[kind][0]} dice rolled a **{name}** (**critical {outcome}**)"
+            )
+
+
+def describe_estimation(P: nodes.P_FIELD) -> str:
+    """Tells how precise an estimated distribution is. Empty for exact ones."""
+    if P.mode != "sampled":
+        return ""
+    low, high = P.mean_interval()
+    median, m_low, m_high = P.percentile_interval(.5)
+    return (f"Estimated from {P.samples} rolls: expected value within [{low:.2f}, {high:.2f}], "
+            f"median {median} within [{m_low}, {m_high}] (95% confidence)")
+
+
+def read_epsilon(cmd: list[str]) -> float:
+    """
+    The pruning asked for by a prune command, split into words: "prune 1e-9", or "prune off" for none.
+    """
+    if len(cmd) != 2:
+        raise ValueError(f"Expected {cmd[0]} followed by a probability, or off")
+    if cmd[1] in ["off", "no", "none"]:
+        return 0.
+    epsilon = float(cmd[1])
+    if not 0 <= epsilon < 1:
+        raise ValueError(f"Cannot leave out {cmd[1]} of the distributions, expected a probability below 1")
+    return epsilon
+
+
+def describe_truncation(P: nodes.P_FIELD) -> str:
+    """Tells how much probability a pruned distribution left out. Empty when none was."""
+    if P.missing_mass <= 0:
+        return ""
+    return f"Values of total probability {P.missing_mass:.1e} left out of the distribution"
+
+
+def decipher(i: str, context: EvalContext = None) -> tuple[int, int, float, nodes.P_FIELD]:
+    """
+    Rolls an instruction, returning the value rolled, the maximum, the expected value and the distribution.
+
+    context defaults to a new one. The settings of the instruction that are meant for the whole session
+    are kept in it, the others are forgotten with the instruction.
+    The instruction is only compiled the first time it is seen (see PLANS).
+    """
+    context = context or EvalContext(verbose=verbose)
+    plan = get_plan(i, context, solved=True)
+    return plan.roll(context), plan.maximum, plan.mean, plan.probas
+
+
+def get_plan(i: str, context: EvalContext = None, solved: bool = False) -> Plan:
+    """The plan of an instruction, compiled the first time it is seen, and solved if asked to"""
+    key = plan_key(i, context.epsilon if context is not None else 0.)
+    plan = PLANS.get_or_compute(key, lambda: compile_plan(i, context=context))
+    if solved and not plan.solved:
+        plan.solve()
+        PLANS.put(key, plan)  # measured again, now that it holds its distributions
+    return plan
+
+
+def roll(i: str, context: EvalContext = None) -> int:
+    """
+    Rolls an instruction, like decipher, but without computing its distribution, maximum nor expected value,
+    so that rolling even huge instructions stays cheap.
+    """
+    context = context or EvalContext(verbose=verbose)
+    return get_plan(i, context).roll(context, distribution=False)
+
+
+def evaluate(
+        command: str, criticals: list[str], epsilon: float = 0.
+) -> tuple[int, int, float, nodes.P_FIELD, list[str], list[str]]:
+    """
+    Same as decipher, meant to run in an executor: the state it depends on goes in and out as data.
+
+    criticals is the list of the dice that are critical for the whole session,
+    epsilon the pruning of the distributions it chose (see EvalContext).
+    Returns the results of decipher, the messages about the criticals,
+    and the list of critical dice as the command left it.
+    """
+    messages = []
+    context = EvalContext(criticals=set(criticals), publisher=messages.append, verbose=verbose, epsilon=epsilon)
+    v, m, a, P = decipher(command, context)
+    return v, m, a, P, messages, sorted(context.criticals)
+
+
+def roll_many(
+        i: str, n: int, seed=None, criticals: bool = False
+) -> np.ndarray | tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Rolls an instruction n times, returning the n results.
+
+    The instruction is only parsed once, and the rolls are drawn with numpy, through a Program.
+    With criticals, also returns, for every roll, the count of natural 1s ('failures')
+    and natural maximums ('successes') of the critical dice.
+    """
+    context = EvalContext(rng=np.random.default_rng(seed), verbose=verbose)
+    tree = _parse(_segment(i, context), context=context)
+    crits = {
+        "failures": np.zeros(n, dtype=np.int64),
+        "successes": np.zeros(n, dtype=np.int64),
+    } if criticals else None
+    results = nodes.Program(tree).sample(n, context, crits)
+    return (results, crits) if criticals else results
 
 
 def colorise(value, proba):
@@ -257,13 +482,18 @@ def colorise(value, proba):
         return "\033[33;1m" + str(value) + "\033[0m"
 
 
-def getF(proba, value) -> float:
-    return sum(proba[k] for k in proba if k <= value)
+def getF(proba: nodes.P_FIELD, value: int) -> float:
+    return proba.at_most(value)
+
+
+def stats_text(P: nodes.P_FIELD) -> str:
+    """The percentiles of P, read from its cumulative index"""
+    return ", ".join(f"p{q} = {P.quantile(q / 100)}" for q in PERCENTILES) + f" (expected {P.mean():.2f})"
 
 
 def main():
     print("\033[37;1m", "-" * 42, "DICE ENVIRONMENT", "-" * 42, "\033[0m", sep="\n")
-    global CRITICAL_DICE_PERM
+    context = EvalContext(verbose=verbose)
     P, v = None, None
     while True:
         try:
@@ -276,27 +506,44 @@ def main():
             break
         elif (cmd := input_str.lower().split())[0] in INPUTS_THAT_ASK_FOR_GRAPH:
             if P is not None:
-                draw_figure_discord(P, v)
+                print(graph_text(P, v))
             else:
                 print("\033[31mCannot graph last dice roll as no dice roll was found in memory\033[0m")
             continue
+        elif cmd[0] in INPUTS_THAT_ASK_FOR_STATS:
+            if P is not None:
+                print(stats_text(P))
+            else:
+                print("\033[31mCannot tell the percentiles of the last dice roll as none was found in memory\033[0m")
+            continue
+        elif cmd[0] in INPUTS_THAT_PRUNE:
+            try:
+                context.epsilon = read_epsilon(cmd)
+                print(f"Distributions now pruned of {context.epsilon:.1e} of their probability at most")
+            except ValueError as e:
+                print(f"\033[31m{e}\033[0m")
+            continue
         elif input_str.lower() in ["dnd", "d&d", "critical", "crit", "dungeon&dragon", "crits", "criticals"
                                                                                                 "dungeon & dragon",
                                    "dungeon and dragon", "count crits", "count criticals",
                                    "count critical", "d&d&d&d"]:
-            CRITICAL_DICE_PERM.append("d20")
+            context.criticals.add("d20")
             print("DND mode active. D20s will now announce critical scores")
             continue
         elif input_str.lower() in ["reset", "reboot", "rb", "boot", "nocrit"]:
-            CRITICAL_DICE_PERM = []
+            context.criticals.clear()
             "Reset"
             print("-" * 63)
             continue
         try:
-            v, m, a, P = decipher(input_str)
+            v, m, a, P = decipher(input_str, context)
             print('\tResult :\n\n' +
                   f'Got {colorise(v, P)} (out of \033[36;1m{m}\033[0m maximum, \033[36;1m{a:.2f}\033[0m expected, ' +
                   f'F = \033[36;1m{100 * getF(P, v):.1f}%\033[0m)')
+            if P.mode == "sampled":
+                print(f'\033[36m{describe_estimation(P)}\033[0m')
+            if context.epsilon > 0 and (truncation := describe_truncation(P)):
+                print(f'\033[36m{truncation}\033[0m')
         except Exception as e:
             print(
                 "\033[31m",  # color red
@@ -313,99 +560,256 @@ def main():
         print("-" * 63)
 
 
-async def draw_figure_discord(P: nodes.P_FIELD, v: int, channel):
-    print(P)
-    import matplotlib as mpl
-    import os
-    import matplotlib.pyplot as plt
-    from matplotlib.patches import FancyBboxPatch
-    from datetime import datetime
+GRAPH_COLORS = {
+    "text": "white",
+    "figure": (66 / 255, 69 / 255, 73 / 255),
+    "axes": (54 / 255, 57 / 255, 62 / 255),
+    "bars": (114 / 255, 137 / 255, 218 / 255),
+}
+
+
+def render_figure(P: nodes.P_FIELD, v: int) -> bytes:
+    """
+    Draws the distribution P, and the roll v, into a PNG image.
 
-    COLOR = 'white'
-    mpl.rcParams['text.color'] = COLOR
-    mpl.rcParams['axes.labelcolor'] = COLOR
-    mpl.rcParams['xtick.color'] = COLOR
-    mpl.rcParams['ytick.color'] = COLOR
+    The figure does not go through pyplot, so it is neither shared nor kept by matplotlib:
+    this can run in any thread or process, and the memory is freed with the figure.
+    """
+    from matplotlib.collections import PatchCollection
+    from matplotlib.figure import Figure
+    from matplotlib.patches import FancyBboxPatch
 
-    fig = plt.figure(facecolor=(66/255, 69/255, 73/255))
+    fig = Figure(facecolor=GRAPH_COLORS["figure"])
     ax = fig.add_subplot(1, 1, 1)
 
-    E = sum([
-        k * P[k]
-        for k in P
-    ]) if P else 0
+    E = P.mean()
 
-    plt.bar(
-        list(P.keys()), list(P.values()), width=.95,
-        color=(114/255, 137/255, 218/255)
-    )
+    keys, values = list(P.keys()), list(P.values())
+    # the bars are drawn at once, as a collection
+    ax.add_collection(PatchCollection([
+        FancyBboxPatch((x - .95 / 2, 0), .95, height, boxstyle="round,pad=1e-3,rounding_size=0.015")
+        for x, height in zip(keys, values)
+    ], edgecolor="none", facecolor=GRAPH_COLORS["bars"]))
+    ax.set_xlim(min(keys) - 1, max(keys) + 1)
 
-    new_patches = []
-    for patch in reversed(ax.patches):
-        bb = patch.get_bbox()
-        color = patch.get_facecolor()
-        p_bbox = FancyBboxPatch(
-            (bb.xmin, 0),
-            abs(bb.width), abs(bb.height),
-            boxstyle="round,pad=1e-3,rounding_size=0.015",
-            ec="none", fc=color,
-        )
-        patch.remove()
-        new_patches.append(p_bbox)
-    for patch in new_patches:
-        ax.add_patch(patch)
-
-    plt.vlines(
+    ax.vlines(
         (v, E), 0,
-        max(*P.values()),
+        max(values),
         colors=('w', 'r')
     )
-    ax.set_ylim(bottom=0)
-    plt.xlabel("Score")
-    plt.ylabel("Probability")
-    plt.legend()
+    ax.set_ylim(bottom=0, top=max(values) * 1.05)
+    ax.set_xlabel("Score", color=GRAPH_COLORS["text"])
+    ax.set_ylabel("Probability", color=GRAPH_COLORS["text"])
+    ax.tick_params(colors=GRAPH_COLORS["text"])
+    ax.set_facecolor(GRAPH_COLORS["axes"])
+
+    image = io.BytesIO()
+    fig.savefig(image, format="png", facecolor=fig.get_facecolor())
+    fig.clear()
+    return image.getvalue()
+
+
+def warm_up() -> None:
+    """Loads matplotlib and draws a first figure, so that the first graph asked for is not slower"""
+    render_figure(nodes.Distribution.uniform(1, 6), 1)
+
+
+def use_graph_directory(directory: str, max_bytes: int = 256 * 2 ** 20) -> None:
+    """Keeps the graphs in directory too, so that they are drawn once for every process and every run"""
+    GRAPHS.backing = DiskCache(directory, max_bytes)
+
+
+def graph_text(P: nodes.P_FIELD, v: int) -> str:
+    """show_P, drawn once per distribution and roll"""
+    return GRAPHS.get_or_compute(("text", P.digest(), int(v)), lambda: show_P(P, v))
+
+
+async def draw_figure_discord(P: nodes.P_FIELD, v: int, channel, executor: Executor = None):
+    """
+    Sends the graph of P to channel.
+    It is drawn by the executor (the default one of the loop if None), once per distribution and roll.
+    """
+    key = ("png", P.digest(), int(v))
+    image = GRAPHS.get(key)
+    if image is None:
+        image = await asyncio.get_running_loop().run_in_executor(executor, render_figure, P, v)
+        GRAPHS.put(key, image)
+    await channel.send(file=discord.File(io.BytesIO(image), filename="graph.png"))
 
-    ax.set_facecolor((54/255, 57/255, 62/255))
-    fname = f'tmp-{int(datetime.now().timestamp() * 10)}.png'
-    plt.savefig(fname)
 
-    await channel.send(file=discord.File(fname))
-    os.unlink(fname)
+async def graph_text_discord(P: nodes.P_FIELD, v: int, executor: Executor = None) -> str:
+    """graph_text, drawn by the executor (the default one of the loop if None) when it was not already"""
+    key = ("text", P.digest(), int(v))
+    text = GRAPHS.get(key)
+    if text is None:
+        text = await asyncio.get_running_loop().run_in_executor(executor, show_P, P, v)
+        GRAPHS.put(key, text)
+    return text
 
 
 async def discord_main(
-        command: str, P: nodes.P_FIELD = None,
-        v: int = None, to_send_to: Callable[[str], None] = None,
-        channel: discord.TextChannel = None
-) -> tuple[str, dict, int]:
-    global CRITICAL_DICE_PERM
+        command: str, session: Session, to_send_to: Callable[[str], None] = None,
+        channel: discord.TextChannel = None,
+        executor: Executor = None, timeout: float = None
+) -> str:
+    """
+    Answers a command of the discord bot, sent in session.
+
+    The roll itself is computed by the executor (the default one of the loop if None),
+    and given up after timeout seconds, so that the bot keeps answering in the meantime.
+    The messages about the criticals are given to to_send_to once the roll is done.
+    """
     if command.lower() in ["", "q", "quit", "no", "bye", "exit", "e", "-q", "-e"]:
         print("\033[36;1mBye !\033[0m")
         raise errors.ShutDownCommand()
     elif (cmd := command.lower().split())[0] in INPUTS_THAT_ASK_FOR_GRAPH:
+        P = session.distribution
+        if P is not None:
+            # both are drawn at once, out of the event loop
+            _, text = await asyncio.gather(
+                draw_figure_discord(P, session.value, channel, executor),
+                graph_text_discord(P, session.value, executor)
+            )
+            return "```\n" + text + "```"
+        else:
+            return "Cannot graph last dice roll as no dice roll was found in memory"
+    elif cmd[0] in INPUTS_THAT_ASK_FOR_STATS:
+        P = session.distribution
         if P is not None:
-            await draw_figure_discord(P, v, channel)
-            return "```\n" + show_P(P, v) + "```", {}, 0
+            return stats_text(P)
         else:
-            return "Cannot graph last dice roll as no dice roll was found in memory", {}, 0
+            return "Cannot tell the percentiles of the last dice roll as none was found in memory"
+    elif cmd[0] in INPUTS_THAT_PRUNE:
+        try:
+            session.epsilon = read_epsilon(cmd)
+        except ValueError as e:
+            return str(e)
+        return f"Distributions now pruned of {session.epsilon:.1e} of their probability at most"
     elif command.lower() in ["dnd", "d&d", "critical", "crit", "dungeon&dragon", "crits", "criticals"
                                                                                           "dungeon & dragon",
                              "dungeon and dragon", "count crits", "count criticals",
                              "count critical", "d&d&d&d"]:
-        CRITICAL_DICE_PERM.append("d20")
-        return "DND mode active. D20s will now announce critical scores", {}, 0
+        session.criticals.add("d20")
+        return "DND mode active. D20s will now announce critical scores"
     elif command.lower() in ["reboot", "rb", "boot", "nocrit"]:
-        CRITICAL_DICE_PERM = []
-        return "Reset", {}, 0
+        session.criticals.clear()
+        return "Reset"
+    future = asyncio.get_running_loop().run_in_executor(
+        executor, evaluate, command, sorted(session.criticals), session.epsilon
+    )
     try:
-        v, m, a, P = decipher(command, add_msg_discord=to_send_to)
-        return '\tResult :\n\n' + \
-               f'Got **{v}** (out of *{m}* maximum, *{a:.2f}* expected, ' + \
-               f'**{100 * getF(P, v):.1f}%** lucky', P, v
+        v, m, a, P, messages, criticals = await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        # waiting for is cancelled, which stops the roll if it has not started yet.
+        # one that already started cannot be stopped, but it no longer holds the bot
+        return f"Gave up on `{command}` after {timeout} seconds"
     except Exception as e:
         print(f"\033[31m{e}\033[0m")
-    print("-" * 63)
+        return str(e)
+    session.criticals = set(criticals)
+    session.remember(v, P)
+    if to_send_to is not None:
+        for message in messages:
+            to_send_to(message)
+    return '\tResult :\n\n' + \
+           f'Got **{v}** (out of *{m}* maximum, *{a:.2f}* expected, ' + \
+           f'**{100 * getF(P, v):.1f}%** lucky)' + \
+           (f'\n*{describe_estimation(P)}*' if P.mode == "sampled" else '') + \
+           (f'\n*{truncation}*' if session.epsilon > 0 and (truncation := describe_truncation(P)) else '')
+
+
+def set_verbose(value: bool) -> None:
+    """Turns on or off what the evaluations print to the terminal, for those not given a context"""
+    global verbose
+    verbose = value
+
+
+def evaluate_line(line: str, distribution: bool = False, roll_only: bool = False) -> str:
+    """
+    Evaluates a single instruction into one line of JSON, errors included.
+    With roll_only, the distribution is never computed: only the value rolled is written,
+    along with the maximum and expected value when they can be told without it.
+    """
+    messages = []
+    result = {"input": line}
+    context = EvalContext(publisher=messages.append, verbose=False)
+    try:
+        if roll_only:
+            plan = get_plan(line, context)
+            result.update(value=plan.roll(context, distribution=False))
+            if plan.moments is not None:
+                result.update(max=int(plan.maximum), expected=float(plan.mean))
+        else:
+            v, m, a, P = decipher(line, context)
+            result.update(value=int(v), max=int(m), expected=float(a), mode=P.mode)
+    except Exception as e:
+        result["error"] = str(e).strip("'").strip('"')
+        return json.dumps(result)
+    if messages:
+        result["criticals"] = [message.replace("**", "") for message in messages]
+    if distribution and not roll_only:
+        result["distribution"] = {str(k): float(p) for k, p in P.items()}
+    return json.dumps(result)
+
+
+def batch(
+        lines: Iterable[str], out: TextIO, distribution: bool = False,
+        workers: int = 0, chunk_size: int = 64, roll_only: bool = False
+) -> None:
+    """
+    Evaluates every non-blank line, writing one line of JSON per instruction to out, in the same order.
+
+    With workers, the lines are evaluated chunk_size at a time by a pool of as many processes.
+    Without, each result is written as soon as it is known, so that the output can be streamed.
+    """
+    lines = (line.strip() for line in lines)
+    lines = (line for line in lines if line)
+    if workers <= 0:
+        for line in lines:
+            out.write(evaluate_line(line, distribution, roll_only) + "\n")
+            out.flush()
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        # one round of chunks per worker at a time, so that an endless input is streamed too
+        while chunk := list(itertools.islice(lines, workers * chunk_size)):
+            results = executor.map(
+                evaluate_line, chunk, itertools.repeat(distribution), itertools.repeat(roll_only),
+                chunksize=chunk_size
+            )
+            out.write("".join(result + "\n" for result in results))
+            out.flush()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="A calculator with dice rolling in mind.")
+    parser.add_argument(
+        "-b", "--batch", nargs="?", const="-", metavar="FILE",
+        help="evaluate the instructions of FILE (or of the standard input), one per line, "
+             "and write one line of JSON per result instead of launching the prompt"
+    )
+    results = parser.add_mutually_exclusive_group()
+    results.add_argument(
+        "-d", "--distribution", action="store_true",
+        help="in batch mode, also write the probability of every possible value"
+    )
+    results.add_argument(
+        "-r", "--roll-only", action="store_true",
+        help="in batch mode, do not compute the distributions, and only write the values rolled "
+             "(and the maximum and expected value of sums, differences and products)"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=0,
+        help="in batch mode, the number of processes evaluating the instructions (none by default)"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=64,
+        help="in batch mode, the number of instructions given to a worker at a time"
+    )
+    args = parser.parse_args()
+    if args.batch is None:
+        main()
+    elif args.batch == "-":
+        batch(sys.stdin, sys.stdout, args.distribution, args.workers, args.chunk_size, args.roll_only)
+    else:
+        with open(args.batch) as f:
+            batch(f, sys.stdout, args.distribution, args.workers, args.chunk_size, args.roll_only)
@@ -0,0 +1,219 @@
+# The following code was provided as part of a project.
+# As such, please refer to the project's LICENSE file.
+# If no such file was included, then no LICENSE was granted,
+# meaning that all usage was against the author's will.
+#
+# In applicable cases, the author reserves themself the right
+# to legally challenge any uses that are against their will,
+# or goes against the LICENSE.
+#
+# Only through a written agreement designating the user
+# (be it physical person or company) by name from the author
+# may the terms of the LICENSE, or lack thereof, be changed.
+#
+# Author: Alex SHP <alex.shp38540@gmail.com>
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+missing = object()
+
+
+class DiskCache:
+    """
+    A cache kept in a directory, one file per entry, so that it outlives the process
+    and can be shared by several of them.
+
+    Files are named after a hash of the repr of their key: keys must have a stable repr.
+    Values are pickled. When the directory grows over max_bytes,
+    the entries that were read or written the longest ago are removed.
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: Hashable) -> str:
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + '.pickle')
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)  # the modification time tells which entries were used last
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        # written aside then moved, so that no reader can see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp, self._path(key))
+        if self.max_bytes is not None:
+            self._shrink()
+
+    def _shrink(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                try:
+                    stat = entry.stat()
+                except OSError:  # removed by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                os.unlink(entry.path)
+
+
+class LRUCache:
+    """
+    A least recently used cache, bounded in number of entries and, optionally, in bytes.
+
+    It can be shared between threads. Values are expected to be immutable,
+    as every caller that asks for a key receives the same object.
+
+    Parameters:
+    -----------
+    max_size: int
+        The maximal number of entries.
+
+    max_bytes: int
+        The maximal total size of the entries, as measured by sizeof.
+        None means no limit.
+
+    sizeof: Callable[[Any], int]
+        How to measure the size of a value in bytes. Required if max_bytes is set.
+
+    backing: DiskCache
+        A slower tier, looked into when a key is missing, and written along with this one.
+        None means none.
+    """
+
+    def __init__(
+            self, max_size: int = 1024, max_bytes: Optional[int] = None,
+            sizeof: Callable[[Any], int] = None, backing: Optional[DiskCache] = None
+    ):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError('A byte limit requires a way to measure the entries (sizeof)')
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.RLock()
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.backing = backing
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, missing)
+            if entry is not missing:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+        if self.backing is None:
+            return default
+        value = self.backing.get(key, missing)
+        if value is missing:
+            return default
+        self._put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._put(key, value)
+        if self.backing is not None:
+            self.backing.put(key, value)
+
+    def _put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self.n_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = value, size
+            self.n_bytes += size
+            self._shrink()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the value cached under key, computing and caching it if needed.
+
+        The computation happens outside the lock, so that a slow one does not block other keys.
+        """
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def resize(self, max_size: int = missing, max_bytes: Optional[int] = missing) -> None:
+        with self._lock:
+            if max_size is not missing:
+                self.max_size = max_size
+            if max_bytes is not missing:
+                if max_bytes is not None and self.sizeof is None:
+                    raise ValueError('A byte limit requires a way to measure the entries (sizeof)')
+                self.max_bytes = max_bytes
+            self._shrink()
+
+    def _shrink(self) -> None:
+        while self._entries and (
+                len(self._entries) > self.max_size
+                or
+                (self.max_bytes is not None and self.n_bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.n_bytes -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries), "bytes": self.n_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+DISTRIBUTIONS = LRUCache(max_size=1024, max_bytes=64 * 2 ** 20, sizeof=lambda d: d.nbytes)
+"""
+The distributions computed by the nodes, shared by every evaluation of the process.
+Keyed by the canonical description of the node (see Node.cache_key).
+"""
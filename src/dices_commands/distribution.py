@@ -0,0 +1,414 @@
+# The following code was provided as part of a project.
+# As such, please refer to the project's LICENSE file.
+# If no such file was included, then no LICENSE was granted,
+# meaning that all usage was against the author's will.
+#
+# In applicable cases, the author reserves themself the right
+# to legally challenge any uses that are against their will,
+# or goes against the LICENSE.
+#
+# Only through a written agreement designating the user
+# (be it physical person or company) by name from the author
+# may the terms of the LICENSE, or lack thereof, be changed.
+#
+# Author: Alex SHP <alex.shp38540@gmail.com>
+import hashlib
+import math
+from collections.abc import Mapping, Iterable, Iterator
+from statistics import NormalDist
+from typing import Callable
+
+import numpy as np
+
+BINARY_OPERATION = Callable[[int, int], int]
+
+FFT_THRESHOLD = 384
+"""
+Both supports need to be at least this long for convolve to go through the FFT.
+Below it, np.convolve is faster (see bench_convolution in dice-bench.py).
+"""
+FFT_NOISE_FLOOR = 1e-14
+"""Probabilities under this value after an FFT are rounding noise, and are set to 0"""
+
+
+def convolve(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, str]:
+    """
+    Convolution of two probability arrays.
+
+    Returns the convolved array, along with the path that computed it ("direct" or "fft").
+    """
+    if min(len(a), len(b)) < FFT_THRESHOLD:
+        return np.convolve(a, b), "direct"
+    n = len(a) + len(b) - 1
+    n_fft = 1 << (n - 1).bit_length()
+    result = np.fft.irfft(np.fft.rfft(a, n_fft) * np.fft.rfft(b, n_fft), n_fft)[:n]
+    # the FFT leaves small negative and non-zero values where there should be none
+    result[result < FFT_NOISE_FLOOR] = 0.
+    result *= a.sum() * b.sum() / result.sum()
+    return result, "fft"
+
+
+class Distribution(Mapping):
+    """
+    The probability field of a node, over integer values.
+
+    The support is stored as an offset and a contiguous array of probabilities,
+    such that `probs[i]` is the probability of rolling `offset + i`.
+    Reading it like a dict (`keys()`, `items()`, `P[k]`...) only sees the values
+    that can actually be rolled.
+    The minimum and the maximum are those of the operations that built it,
+    even when their probabilities are too small to be represented.
+
+    `convolution` tells which path of `convolve` computed it, if any.
+    The cumulative probabilities are built the first time they are needed, and kept along:
+    P(X <= x), P(X >= x) and the quantiles are then binary searches in them.
+    """
+    __slots__ = ('offset', 'probs', 'convolution', '_cumulated')
+
+    def __init__(self, offset: int, probs: np.ndarray, convolution: str | None = None):
+        self.offset: int = int(offset)
+        self.probs: np.ndarray = np.asarray(probs, dtype=float)[:]
+        self.probs.setflags(write=False)
+        self.convolution = convolution
+        self._cumulated: np.ndarray | None = None
+
+    @classmethod
+    def constant(cls, value: int) -> 'Distribution':
+        return cls(value, np.ones(1))
+
+    @classmethod
+    def uniform(cls, low: int, high: int) -> 'Distribution':
+        """Every integer in [low, high] is equally likely"""
+        return cls(low, np.full(high - low + 1, 1 / (high - low + 1)))
+
+    @classmethod
+    def from_dict(cls, d: dict[int, float]) -> 'Distribution':
+        if not d:
+            return cls(0, np.zeros(0))
+        keys = np.fromiter(d.keys(), dtype=np.int64, count=len(d))
+        weights = np.fromiter(d.values(), dtype=float, count=len(d))
+        low = int(keys.min())
+        return cls(low, np.bincount(keys - low, weights=weights))
+
+    @classmethod
+    def binomial(cls, n: int, p: float) -> 'Distribution':
+        """Number of successes out of n independent tries, each succeeding with probability p"""
+        successes = np.arange(n + 1)
+        if p <= 0. or p >= 1.:
+            return cls(0, (successes == (n if p >= 1. else 0)).astype(float))
+        # log(n choose k) is built incrementally, as the binomial coefficients themselves overflow
+        log_comb = np.concatenate([[0.], np.cumsum(np.log(np.arange(n, 0, -1) / np.arange(1, n + 1)))])
+        return cls(0, np.exp(log_comb + successes * np.log(p) + (n - successes) * np.log1p(-p)))
+
+    @classmethod
+    def mixture(cls, weighted: Iterable[tuple['Distribution', float]]) -> 'Distribution':
+        """The distribution obtained by picking each distribution with the given probability"""
+        weighted = [(d, w) for d, w in weighted if len(d.probs) > 0]
+        if not weighted:
+            return cls(0, np.zeros(0))
+        low = min(d.offset for d, _ in weighted)
+        high = max(d.max for d, _ in weighted)
+        probs = np.zeros(high - low + 1)
+        for d, w in weighted:
+            probs[d.offset - low:d.max - low + 1] += w * d.probs
+        return cls(low, probs)
+
+    @property
+    def support(self) -> np.ndarray:
+        """Every integer between the minimum and the maximum, even those that cannot be rolled"""
+        return np.arange(self.offset, self.offset + len(self.probs))
+
+    @property
+    def min(self) -> int:
+        return self.offset
+
+    @property
+    def max(self) -> int:
+        return self.offset + len(self.probs) - 1
+
+    @property
+    def mode(self) -> str:
+        """How the distribution was obtained"""
+        return "exact"
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory held by the probabilities and by their cumulative index.
+        The index is counted even before it is built: the caches measure their entries once, when they are put.
+        """
+        return 2 * self.probs.nbytes
+
+    def mean(self) -> float:
+        if len(self.probs) == 0:
+            return 0.
+        return float(np.dot(self.support, self.probs))
+
+    def variance(self) -> float:
+        if len(self.probs) == 0:
+            return 0.
+        centered = self.support - self.mean()
+        return float(np.dot(centered * centered, self.probs))
+
+    def non_zero(self) -> tuple[np.ndarray, np.ndarray]:
+        """The values that can be rolled, and their probabilities"""
+        idx = np.flatnonzero(self.probs)
+        return self.support[idx], self.probs[idx]
+
+    def __add__(self, other: 'Distribution') -> 'Distribution':
+        return Distribution(self.offset + other.offset, *convolve(self.probs, other.probs))
+
+    def __sub__(self, other: 'Distribution') -> 'Distribution':
+        # X - Y is X + (-Y), and -Y is Y read backwards
+        return Distribution(self.offset - other.max, *convolve(self.probs, other.probs[::-1]))
+
+    def combine(self, other: 'Distribution', operation: BINARY_OPERATION | np.ufunc) -> 'Distribution':
+        """
+        Distribution of operation(X, Y), X and Y being independent.
+
+        The operation is evaluated over the outer product of both supports,
+        and the probabilities are then summed by result with a bincount.
+        A numpy ufunc computes the whole product at once, any other operation is called for every pair.
+        """
+        if len(self.probs) == 0 or len(other.probs) == 0:
+            return Distribution(0, np.zeros(0))
+        # the whole supports are used, as the extremes may be too unlikely to be represented
+        if isinstance(operation, np.ufunc):
+            with np.errstate(divide='raise'):
+                try:
+                    results = operation.outer(self.support, other.support)
+                except FloatingPointError as e:
+                    raise ZeroDivisionError(str(e)) from e
+        else:
+            results = np.frompyfunc(operation, 2, 1).outer(self.support, other.support).astype(float)
+        if results.dtype.kind not in 'biu':
+            rounded = np.rint(results)
+            if not np.array_equal(rounded, results):
+                raise TypeError('Distributions can only hold integer values')
+            results = rounded
+        results = results.astype(np.int64).ravel()
+        low = int(results.min())
+        return Distribution(low, np.bincount(results - low, weights=np.outer(self.probs, other.probs).ravel()))
+
+    def power(
+            self, n: int,
+            operation: Callable[['Distribution', 'Distribution'], 'Distribution'] = None
+    ) -> 'Distribution':
+        """
+        The distribution combined with itself n times, by repeated squaring.
+
+        Only O(log n) operations are needed, as long as the operation is associative.
+        The operation defaults to a sum, in which case n may be 0.
+        """
+        if operation is None:
+            operation = Distribution.__add__
+            if n == 0:
+                return Distribution.constant(0)
+        if n < 1:
+            raise ValueError(f'Cannot combine a distribution with itself {n} times')
+        result = None
+        square = self
+        while True:
+            if n & 1:
+                result = square if result is None else operation(result, square)
+            n >>= 1
+            if not n:
+                return result
+            square = operation(square, square)
+
+    def prune(self, epsilon: float) -> 'Distribution':
+        """
+        The smallest interval of the distribution that holds all of its mass but epsilon at most.
+
+        The probabilities left out are not given to the others, so that what was left out
+        is still known (see missing_mass).
+        """
+        n = len(self.probs)
+        if epsilon <= 0 or n < 2:
+            return self
+        # the mass of the i first values, and of the j last, for every i and j
+        first = np.concatenate(([0.], np.cumsum(self.probs)))
+        last = np.concatenate(([0.], np.cumsum(self.probs[::-1])))
+        # for every i, the most values that can be dropped from the end along (-1 when none)
+        dropped_last = np.searchsorted(last, epsilon - first[:n], side='right') - 1
+        dropped_last = np.minimum(dropped_last, n - 1 - np.arange(n))  # at least a value is kept
+        i = int(np.argmax(np.where(dropped_last >= 0, np.arange(n) + dropped_last, -1)))
+        j = int(dropped_last[i])
+        if i + j == 0:
+            return self
+        return Distribution(self.offset + i, self.probs[i:n - j], self.convolution)
+
+    @property
+    def missing_mass(self) -> float:
+        """The probability left out of the distribution by pruning (up to the rounding errors)"""
+        return max(0., 1. - math.fsum(self.probs))
+
+    def cdf(self) -> np.ndarray:
+        """P(X <= x) for every x of the support, computed once"""
+        if self._cumulated is None:
+            cumulated = np.cumsum(self.probs)
+            cumulated.setflags(write=False)
+            self._cumulated = cumulated
+        return self._cumulated
+
+    def at_most(self, value: int) -> float:
+        """P(X <= value)"""
+        # the number of values of the support up to value, the support being evenly spaced
+        rank = min((value - self.offset) // self.step + 1, len(self.probs))
+        return float(self.cdf()[rank - 1]) if rank > 0 else 0.
+
+    def at_least(self, value: int) -> float:
+        """P(X >= value)"""
+        cumulated = self.cdf()
+        return float(cumulated[-1]) - self.at_most(value - 1) if len(cumulated) else 0.
+
+    def quantile(self, q: float) -> int:
+        """The smallest value x of the support such that P(X <= x) >= q"""
+        rank = np.searchsorted(self.cdf(), q, side='left')
+        return self.offset + self.step * int(max(min(rank, len(self.probs) - 1), 0))
+
+    @property
+    def step(self) -> int:
+        """The gap between two consecutive values of the support"""
+        return 1
+
+    def sf(self) -> np.ndarray:
+        """P(X >= x) for every x of the support"""
+        return np.cumsum(self.probs[::-1])[::-1]
+
+    def max_of(self, counts: 'Distribution') -> 'Distribution':
+        """
+        Distribution of the maximum of N rolls, N following counts (less than one roll counts as one).
+
+        P(max <= x) is F(x) ** N, which is computed for every count at once.
+        """
+        return self._extreme_of(counts, self.cdf(), lambda powers: np.diff(powers, prepend=0.))
+
+    def min_of(self, counts: 'Distribution') -> 'Distribution':
+        """
+        Distribution of the minimum of N rolls, N following counts (less than one roll counts as one).
+
+        P(min >= x) is (1 - F(x - 1)) ** N, which is computed for every count at once.
+        """
+        return self._extreme_of(counts, self.sf(), lambda powers: -np.diff(powers, append=0.))
+
+    def _extreme_of(
+            self, counts: 'Distribution', cumulated: np.ndarray,
+            to_probs: Callable[[np.ndarray], np.ndarray]
+    ) -> 'Distribution':
+        n_rolls, weights = counts.non_zero()
+        powers = cumulated[np.newaxis, :] ** np.maximum(n_rolls, 1)[:, np.newaxis]
+        return Distribution(self.offset, weights @ to_probs(powers))
+
+    def sample(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        """Draws n values, by inverting the cumulative distribution"""
+        cumulated = self.cdf()
+        drawn = np.searchsorted(cumulated, rng.random(n) * cumulated[-1], side='right')
+        return self.support[np.minimum(drawn, len(self.probs) - 1)]
+
+    def digest(self) -> str:
+        """A hash of the content of the distribution, the same for any two equal distributions"""
+        digest = hashlib.blake2b(repr(self._identity()).encode(), digest_size=16)
+        digest.update(self.probs.tobytes())
+        return digest.hexdigest()
+
+    def _identity(self) -> tuple:
+        # what, besides the probabilities, tells two distributions apart
+        return self.__class__.__name__, self.offset
+
+    def copy(self) -> 'Distribution':
+        # the probabilities, and so their cumulative index, are read-only: they can be shared
+        copy = Distribution(self.offset, self.probs, self.convolution)
+        copy._cumulated = self._cumulated
+        return copy
+
+    def __getitem__(self, key: int) -> float:
+        idx = key - self.offset
+        if isinstance(key, (int, np.integer)) and 0 <= idx < len(self.probs) and self.probs[idx] > 0:
+            return float(self.probs[idx])
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.non_zero()[0].tolist())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.probs))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self.items())})"
+
+
+class SampledDistribution(Distribution):
+    """
+    A distribution estimated from a number of rolls, used when computing it exactly would cost too much.
+
+    `samples` is the number of rolls it was estimated from. When the rolls spread over more than
+    MAX_BINS values, they are grouped into bins of `step` consecutive values, each bin being
+    represented by its lowest value. The mean and the variance are those of the rolls themselves.
+    """
+    __slots__ = ('samples', 'step', '_mean', '_variance')
+
+    MAX_BINS = 100_000
+
+    def __init__(self, offset: int, probs: np.ndarray, samples: int, step: int = 1,
+                 mean: float = None, variance: float = None):
+        super().__init__(offset, probs)
+        self.samples = samples
+        self.step = step
+        self._mean = super().mean() if mean is None else mean
+        self._variance = super().variance() if variance is None else variance
+
+    @classmethod
+    def from_samples(cls, rolls: np.ndarray) -> 'SampledDistribution':
+        low = int(rolls.min())
+        step = max(1, -(-(int(rolls.max()) - low + 1) // cls.MAX_BINS))
+        return cls(low, np.bincount((rolls - low) // step) / len(rolls), len(rolls), step,
+                   float(rolls.mean()), float(rolls.var()))
+
+    @property
+    def mode(self) -> str:
+        return "sampled"
+
+    @property
+    def support(self) -> np.ndarray:
+        return self.offset + self.step * np.arange(len(self.probs))
+
+    @property
+    def max(self) -> int:
+        return self.offset + self.step * (len(self.probs) - 1)
+
+    def mean(self) -> float:
+        return self._mean
+
+    def variance(self) -> float:
+        return self._variance
+
+    def mean_interval(self, confidence: float = .95) -> tuple[float, float]:
+        """Confidence interval of the mean, from the central limit theorem"""
+        spread = NormalDist().inv_cdf((1 + confidence) / 2) * np.sqrt(self.variance() / self.samples)
+        return self.mean() - spread, self.mean() + spread
+
+    def percentile_interval(self, q: float, confidence: float = .95) -> tuple[int, int, int]:
+        """
+        The q-quantile (0 < q < 1) of the rolls, along with the bounds of its confidence interval.
+
+        The interval is distribution-free: the number of rolls under the true quantile follows
+        a binomial law, approximated by a normal law.
+        """
+        spread = NormalDist().inv_cdf((1 + confidence) / 2) * np.sqrt(self.samples * q * (1 - q))
+        ranks = np.clip(np.array([q * self.samples, q * self.samples - spread, q * self.samples + spread]),
+                        1, self.samples)
+        counts = np.rint(self.cdf() * self.samples)
+        estimate, low, high = self.support[np.searchsorted(counts, ranks, side='left')]
+        return int(estimate), int(low), int(high)
+
+    def _identity(self) -> tuple:
+        return super()._identity() + (self.step, self._mean, self._variance)
+
+    def __getitem__(self, key: int) -> float:
+        if (key - self.offset) % self.step:
+            raise KeyError(key)
+        return super().__getitem__(self.offset + (key - self.offset) // self.step)
+
+    def copy(self) -> 'SampledDistribution':
+        return SampledDistribution(self.offset, self.probs, self.samples, self.step, self._mean, self._variance)
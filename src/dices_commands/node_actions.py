@@ -12,45 +12,131 @@
 # may the terms of the LICENSE, or lack thereof, be changed.
 #
 # Author: Alex SHP <alex.shp38540@gmail.com>
+import copy
+import dataclasses
+import functools
 import warnings
 from abc import ABC, abstractmethod
-import random
 from typing import Type, Callable, Optional, Union
 import re
 
+import numpy as np
+
+from .cache import DISTRIBUTIONS
+from .distribution import Distribution, FFT_THRESHOLD
 from .utils import ansi_skipping_len, clean_re
 
 missing = object()
 
 Number = int | float
-P_FIELD = dict[Number, float]
+P_FIELD = Distribution
 ExecutionResult = tuple[Number, P_FIELD]
 OPERATION = Callable[[Number, Number], Number]
 PUBLISHER_T = Callable[[str], None]
+CRITS_T = dict[str, np.ndarray] | None
+Moments = tuple[float, float]
+"""The mean and the variance of a node"""
+
+EXACT_BUDGET = 5_000_000
+"""Number of probabilities an instruction may need to compute before its distribution is estimated by rolling it"""
+MONTE_CARLO_SAMPLES = 100_000
+"""Number of rolls an estimated distribution is built from"""
+
+
+@dataclasses.dataclass
+class EvalContext:
+    """
+    Everything an evaluation depends on, besides the instruction.
+    Each evaluation gets its own, so that several of them can run at once.
+
+    criticals: the dice (such as 'd20') that announce their criticals for the whole session.
+    temporary_criticals: the ones that do so for the current instruction only.
+    rng: the generator every roll is drawn from.
+    publisher: called with every announcement (such as the criticals), if any.
+    verbose: whether to print what happens in the terminal.
+    epsilon: the probability that a distribution combined from two others may leave out of its tails
+    (see Distribution.prune). 0 keeps them whole.
+    """
+    criticals: set[str] = dataclasses.field(default_factory=set)
+    temporary_criticals: set[str] = dataclasses.field(default_factory=set)
+    rng: np.random.Generator = dataclasses.field(default_factory=np.random.default_rng)
+    publisher: Optional[PUBLISHER_T] = None
+    verbose: bool = True
+    epsilon: float = 0.
+
+    def is_critical(self, size: int) -> bool:
+        return f'd{size}' in self.criticals or f'd{size}' in self.temporary_criticals
+
+    def announce(self, terminal: str, message: str) -> None:
+        """Prints terminal (if verbose) and publishes message (if there is a publisher)"""
+        if self.verbose:
+            print(terminal)
+        if self.publisher is not None:
+            self.publisher(message)
+
+    def about(self, prefix: str) -> 'EvalContext':
+        """The same context, whose published messages start with prefix"""
+        if self.publisher is None:
+            return self
+        publisher = self.publisher
+        return dataclasses.replace(self, publisher=lambda s: publisher(prefix + s))
+
+
+STEP_T = Callable[[list[np.ndarray], int, EvalContext, CRITS_T], None]
+"""A step of a Program: takes the rolls of its operands from the top of the stack and pushes its own"""
+
+
+def combine(d1: P_FIELD, d2: P_FIELD, operation: OPERATION) -> P_FIELD:
+    return d1.combine(d2, operation)
+
 
-CRITICAL_DICE_PERM = []
-CRITICAL_DICE_TMP = []
+def width(bounds: tuple[int, int]) -> int:
+    return bounds[1] - bounds[0] + 1
 
 
-def combine(d1: P_FIELD, d2: P_FIELD, operation: OPERATION):
-    result: dict[Number, float] = {}
-    for v1 in d1:
-        for v2 in d2:
-            y = operation(v1, v2)
-            if y not in result:
-                result[y] = d1[v1] * d2[v2]
+def convolution_cost(left_width: int, right_width: int) -> int:
+    """
+    The work of convolving two supports, on the scale of EXACT_BUDGET:
+    every pair of values when they are short, n log n over both of them through the FFT.
+    """
+    if min(left_width, right_width) < FFT_THRESHOLD:
+        return left_width * right_width
+    return (left_width + right_width) * max((left_width + right_width).bit_length(), 1)
+
+
+def power_cost(base_width: int, n: int) -> int:
+    """The cost of the convolutions of Distribution.power, over the widths they actually have"""
+    cost, result_width, square_width = 0, 0, base_width
+    while True:
+        if n & 1:
+            if result_width:
+                cost += convolution_cost(result_width, square_width)
+                result_width += square_width - 1
             else:
-                result[y] += d1[v1] * d2[v2]
-    return result
+                result_width = square_width
+        n >>= 1
+        if not n:
+            return cost
+        cost += convolution_cost(square_width, square_width)
+        square_width = 2 * square_width - 1
 
 
 class Node(ABC):
     __children__: dict[re.Pattern, Type['Node']] = {}
+    __tokens__: dict[str, Type['Node']] = {}
+    """
+    The node types made by an exact token, looked up before trying any pattern of __children__
+    """
+    _dispatcher: tuple[re.Pattern, list[Type['Node']]] | None = None
     is_value: False
     priority_modifier: int = 4
     """
     A modifier of the priority of the node, should be less than 10, more than 0
     """
+    ufunc: np.ufunc | None = None
+    """
+    The numpy equivalent of _op, if any, used to apply it to whole arrays of rolls, and of values in combine
+    """
 
     def __init__(self, expression: str, base_priority: int = 0):
         self._probas: P_FIELD | None = None
@@ -60,16 +146,19 @@ class Node(ABC):
         self.left_child: Optional[Node] = None
         self.right_child: Optional[Node] = None
         self._solved = False
+        self._structure: tuple[int, Optional[DiceNode]] | None = None  # see freeze
 
     def __init_subclass__(
             cls,
-            command: str = missing,
+            command: str | None = missing,
+            tokens: tuple[str, ...] = (),
     ):
-        if command is missing:
+        if command is missing and not tokens:
             raise ValueError(
                 'Missing the value required to determine which actions to take. '
                 f'Please pass, when defining {cls.__name__}, '
-                'the kwargs "command" or "commands" with the name of the command'
+                'the kwargs "command" or "tokens" with the name of the command '
+                '(command=None for abstract node types)'
             )
         if cls.priority_modifier >= 10:
             warnings.warn(f"Priority offset is more than 10 ({cls.priority_modifier}). "
@@ -80,29 +169,95 @@ class Node(ABC):
             )
 
         # print(command)
-        cls.__children__[re.compile(command)] = cls
+        for token in tokens:
+            Node.__tokens__[token] = cls
+        if command is not missing and command is not None:
+            Node.__children__[re.compile(command)] = cls
+            Node._dispatcher = None  # rebuilt on the next call to make
+
+    @staticmethod
+    def _dispatch(expression: str) -> Optional[Type['Node']]:
+        """
+        Finds the node type of an expression that is not an exact token.
+
+        All the patterns are tried at once through a single regular expression,
+        each of them in its own named group, in the order they were registered in.
+        """
+        if Node._dispatcher is None:
+            subclasses = list(Node.__children__.values())
+            combined = re.compile('|'.join(
+                f'(?P<_{i}>{pattern.pattern})' for i, pattern in enumerate(Node.__children__)
+            ))
+            Node._dispatcher = combined, subclasses
+        combined, subclasses = Node._dispatcher
+        match = combined.match(expression)
+        if match is None:
+            return None
+        # the group of the pattern is always the last to close, whatever groups the pattern has
+        return subclasses[int(match.lastgroup[1:])]
 
     def expected_value(self):
         if not self._solved:
             raise ValueError('Required expected value before running the node')
-        return (
-            sum(
-                [
-                    s * self._probas[s] for s in self._probas
-                ]
-            ) / len(self._probas)
-            if len(self._probas) > 0 else 0.
-        )
+        return self._probas.mean()
 
-    def run(self, add_msg_discord: PUBLISHER_T = None) -> ExecutionResult:
-        l_value, l_probas = self.left_child.run()
-        r_value, r_probas = self.right_child.run()
+    def run(self, context: EvalContext = None) -> ExecutionResult:
+        """
+        Rolls the node, returning the value rolled and the distribution of the node.
+        context defaults to a new one, with no critical die.
+        """
+        context = context or EvalContext()
+        l_value, l_probas = self.left_child.run(context)
+        r_value, r_probas = self.right_child.run(context)
         self.last_value = self._op(l_value, r_value)
         self._solved = True
         if self._probas is None:
-            self._probas = self.combine(l_probas, r_probas)
+            self._probas = self._cached(
+                lambda: self.combine(l_probas, r_probas).prune(context.epsilon), context.epsilon
+            )
         return self.last_value, self._probas
 
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        """
+        Rolls the node n times at once with the generator of context, returning the n results.
+
+        crits, when given, holds two arrays of n counters, 'failures' and 'successes',
+        that are incremented for every natural 1 or natural maximum of the critical dice of context.
+        """
+        return self._vectorized_op(
+            self.left_child.sample(n, context, crits),
+            self.right_child.sample(n, context, crits)
+        )
+
+    def postfix(self) -> list[Union['Node', STEP_T]]:
+        """
+        What rolls the node in a Program, in postfix order:
+        its children, to be lowered in turn, and the steps that roll the node from their rolls.
+        The rolls are drawn in the same order as sample draws them.
+        """
+        op = self._vectorized_op
+
+        def step(stack: list[np.ndarray], n: int, context: EvalContext, crits: CRITS_T) -> None:
+            right = stack.pop()
+            stack[-1] = op(stack[-1], right)
+
+        return [self.left_child, self.right_child, step]
+
+    def _sampling_step(self) -> STEP_T:
+        """A step that pushes the rolls of the node, sampled as a whole"""
+        sample = self.sample
+
+        def step(stack: list[np.ndarray], n: int, context: EvalContext, crits: CRITS_T) -> None:
+            stack.append(sample(n, context, crits))
+
+        return step
+
+    def _vectorized_op(self, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='raise'):
+            if self.ufunc is not None:
+                return np.asarray(self.ufunc(left, right), dtype=np.int64)
+        return np.frompyfunc(self._op, 2, 1)(left, right).astype(np.int64)
+
     @abstractmethod
     def _op(self, left: Number, right: Number) -> Number:
         """
@@ -113,7 +268,78 @@ class Node(ABC):
         raise NotImplementedError
 
     def combine(self, d1: P_FIELD, d2: P_FIELD) -> P_FIELD:
-        return combine(d1, d2, self._op)
+        return combine(d1, d2, self._op if self.ufunc is None else self.ufunc)
+
+    def cache_key(self) -> tuple | None:
+        """
+        A canonical description of the distribution of this node, such as ('dice', 8, 6).
+        Nodes with the same key share their distribution through the DISTRIBUTIONS cache.
+        None when the distribution cannot be described.
+        """
+        if self.left_child is None or self.right_child is None:
+            return None
+        left, right = self.left_child.cache_key(), self.right_child.cache_key()
+        if left is None or right is None:
+            return None
+        return self.__class__.__name__, left, right
+
+    def bounds(self) -> tuple[int, int]:
+        """The lowest and highest values the node can take, found without computing its distribution"""
+        (l_min, l_max), (r_min, r_max) = self.left_child.bounds(), self.right_child.bounds()
+        # a divisor ranging over 0 is largest in magnitude by -1 or 1, inside the interval
+        rights = {r_min, r_max} | {right for right in (-1, 1) if r_min <= right <= r_max}
+        corners = []
+        for left in (l_min, l_max):
+            for right in rights:
+                try:
+                    corners.append(self._op(left, right))
+                except ZeroDivisionError:
+                    pass
+        return (min(corners), max(corners)) if corners else (0, 0)
+
+    def moments(self) -> Moments | None:
+        """
+        The mean and variance of the node, found without computing its distribution.
+        None when they cannot be told that way.
+        """
+        # folded from the leaves up, without recursing (see walk)
+        known: dict[int, Moments | None] = {}
+        for node in reversed(self.walk()):
+            if type(node).moments is not Node.moments:
+                # the node tells its moments by itself
+                known[id(node)] = node.moments()
+            elif node.left_child is None or node.right_child is None:
+                known[id(node)] = None
+            else:
+                left, right = known[id(node.left_child)], known[id(node.right_child)]
+                known[id(node)] = None if left is None or right is None else node._combine_moments(left, right)
+        return known[id(self)]
+
+    def _combine_moments(self, left: Moments, right: Moments) -> Moments | None:
+        """The moments of the operation of two independent sides, from theirs. None if unknown."""
+        return None
+
+    def estimated_cost(self) -> int:
+        """
+        An estimate of the number of probabilities computed to get the distribution of this node,
+        found without computing it.
+        """
+        return (
+            self._combine_cost(width(self.left_child.bounds()), width(self.right_child.bounds()))
+            + self.left_child.estimated_cost()
+            + self.right_child.estimated_cost()
+        )
+
+    def _combine_cost(self, left_width: int, right_width: int) -> int:
+        # the operation is evaluated over every pair of values
+        return left_width * right_width
+
+    def _cached(self, compute: Callable[[], P_FIELD], epsilon: float = 0.) -> P_FIELD:
+        """The distribution of the node, from DISTRIBUTIONS if possible, pruned by epsilon if it was"""
+        key = self.cache_key()
+        if key is None:
+            return compute()
+        return DISTRIBUTIONS.get_or_compute(key if not epsilon else ('pruned', epsilon, key), compute)
 
     def _to_str(self) -> tuple[list[str], int]:
         if self.is_value:
@@ -156,10 +382,10 @@ class Node(ABC):
 
     @classmethod
     def make(cls, expression: str, base_priority: int = 0) -> "Node":
-        for pattern, subclass in cls.__children__.items():
-            if pattern.match(expression):
-                # print(f"Matched {subclass.__name__} for {expression}")
-                return subclass(expression, base_priority)
+        subclass = cls.__tokens__.get(expression) or cls._dispatch(expression)
+        if subclass is not None:
+            # print(f"Matched {subclass.__name__} for {expression}")
+            return subclass(expression, base_priority)
         raise KeyError(
             f"Could not find any node type to match symbol {expression}. "
             f"Please check the spelling.\n"
@@ -168,15 +394,63 @@ class Node(ABC):
                 (
                     ['', '', '', '', '\n\t'][i % 5] # newline for readability
                     +
-                    repr(clean_re(patt))
+                    repr(symbol)
+                )
+                for i, symbol in enumerate(
+                    [*cls.__tokens__, *filter(None, map(clean_re, cls.__children__))]
                 )
-                for i, patt in enumerate(cls.__children__)
-                if clean_re(patt)
             )
             + "]"
         )
 
+    def freeze(self) -> None:
+        """
+        Computes once what cannot change anymore once the tree is parsed,
+        for a tree that is to be run many times (see count_dices_children and first_die_child)
+        """
+        # the children first, so that each node reads what they computed without going further down
+        for node in reversed(self.walk()):
+            node._structure = node.count_dices_children(), node.first_die_child()
+
+    def walk(self) -> list['Node']:
+        """
+        The nodes of the tree, every node before its children.
+        The tree is walked without recursing, as the trees of long instructions are deep.
+        """
+        nodes, stack = [], [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(child for child in (node.right_child, node.left_child) if child is not None)
+        return nodes
+
+    def clone(self) -> 'Node':
+        """
+        A copy of the tree, to be run without changing it (running a node keeps what it rolled).
+        The distributions are read-only, the copy shares them.
+        """
+        # the nodes are copied, and then linked to the copies of their children
+        copies: dict[int, Node] = {id(node): node._copy() for node in self.walk()}
+        for node in copies.values():
+            if node.left_child is not None:
+                node.left_child = copies[id(node.left_child)]
+            if node.right_child is not None:
+                node.right_child = copies[id(node.right_child)]
+            if node._structure is not None and node._structure[1] is not None:
+                node._structure = node._structure[0], copies[id(node._structure[1])]
+        return copies[id(self)]
+
+    def _copy(self) -> 'Node':
+        """A copy of this node alone, see clone"""
+        return copy.copy(self)
+
+    def held_bytes(self) -> int:
+        """The size of the distributions held by the node and its children"""
+        return sum(node._probas.nbytes for node in self.walk() if node._probas is not None)
+
     def count_dices_children(self) -> int:
+        if self._structure is not None:
+            return self._structure[0]
         if isinstance(self, DiceNode):
             return 1
         count = 0
@@ -187,6 +461,8 @@ class Node(ABC):
         return count
 
     def first_die_child(self) -> Union['DiceNode', None]:
+        if self._structure is not None:
+            return self._structure[1]
         if isinstance(self, DiceNode):
             return self
         dn = None
@@ -237,7 +513,40 @@ class Node(ABC):
         return self.base_priority + self.priority_modifier
 
 
-def node(symbol: str, strict: bool = True, priority_modifier: int = 4) -> Callable[[OPERATION], Type[Node]]:
+class Program:
+    """
+    A tree lowered into a flat list of steps, to roll it many times at once.
+
+    The steps run over a stack of rolls, in a single loop: sampling a program
+    does not go through a recursive call per node, whatever the depth of its tree,
+    and draws the same rolls as Node.sample from the same generator.
+    """
+    __slots__ = ('steps',)
+
+    def __init__(self, tree: Node):
+        steps: list[STEP_T] = []
+        pending: list[Node | STEP_T] = [tree]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, Node):
+                pending.extend(reversed(item.postfix()))
+            else:
+                steps.append(item)
+        self.steps: tuple[STEP_T, ...] = tuple(steps)
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        """Same as Node.sample, for the tree of the program"""
+        stack: list[np.ndarray] = []
+        for step in self.steps:
+            step(stack, n, context, crits)
+        return stack[0]
+
+
+def node(
+        symbol: str, strict: bool = True, priority_modifier: int = 4,
+        distribution_op: Callable[[P_FIELD, P_FIELD], P_FIELD] = None,
+        ufunc: np.ufunc = None, moments_op: Callable[[Moments, Moments], Moments] = None
+) -> Callable[[OPERATION], Type[Node]]:
     """
     Converts a simple function into a node
 
@@ -251,6 +560,19 @@ def node(symbol: str, strict: bool = True, priority_modifier: int = 4) -> Callab
         If set to false, then the symbol "+" may be matched by "+-".
         Defaults to True.
 
+    distribution_op: Callable[[P_FIELD, P_FIELD], P_FIELD]
+        A faster way to combine the probability fields of both sides,
+        such as Distribution.__add__ for a sum.
+        If absent, the operation is evaluated on every pair of values.
+
+    ufunc: np.ufunc
+        The numpy function that computes the same operation over arrays, such as np.add.
+        If absent, the operation is applied to the rolls, and to the pairs of values of the distributions, one by one.
+
+    moments_op: Callable[[Moments, Moments], Moments]
+        The mean and variance of the operation of two independent sides, from theirs.
+        If absent, they are only known through the distribution of the node.
+
     Examples:
     ---------
         In the following example
@@ -263,28 +585,31 @@ def node(symbol: str, strict: bool = True, priority_modifier: int = 4) -> Callab
         Using the command '1 hi 2' in dices will return 3.
 
     """
-    if strict:
-        for sc in [
-            "\\", "|"
-                  ".", "^", "$", "*",
-            "+", "?", "{", '}',
-            "(", ")", "[", "]"
-        ]:
-            symbol = symbol.replace(sc, f"\\{sc}")
-        if not symbol.startswith('^'):
-            symbol = "^" + symbol
-        if not symbol.endswith('$'):
-            symbol += '$'
+    # a strict symbol is an exact token, looked up directly rather than matched
+    command, tokens = (None, (symbol,)) if strict else (symbol, ())
 
     pm = priority_modifier
+    uf = ufunc
 
     def __wrapped__(operation: OPERATION):
-        class GeneratedNodeType(Node, command=symbol):
+        class GeneratedNodeType(Node, command=command, tokens=tokens):
             priority_modifier = pm
+            ufunc = uf
 
             def _op(self, left: Number, right: Number) -> Number:
                 return operation(left, right)
 
+            if distribution_op is not None:
+                def combine(self, d1: P_FIELD, d2: P_FIELD) -> P_FIELD:
+                    return distribution_op(d1, d2)
+
+                def _combine_cost(self, left_width: int, right_width: int) -> int:
+                    return convolution_cost(left_width, right_width)
+
+            if moments_op is not None:
+                def _combine_moments(self, left: Moments, right: Moments) -> Moments:
+                    return moments_op(left, right)
+
         GeneratedNodeType.__name__ = operation.__name__
         # print(f"Generated {GeneratedNodeType=} with {symbol=}")
         return GeneratedNodeType
@@ -292,18 +617,50 @@ def node(symbol: str, strict: bool = True, priority_modifier: int = 4) -> Callab
     return __wrapped__
 
 
+@functools.lru_cache(maxsize=1024)
+def parse_dice(expression: str) -> tuple[int, int]:
+    """
+    The number and size of the dice of an expression such as '3d6' or 'd20',
+    parsed once for every time the same dice are rolled
+    """
+    number, size = expression.split('d')
+    return int(number or 1), int(size)
+
+
 class ValueNode(Node, command=r'\d+$'):
     priority_modifier = 0
 
+    def __init__(self, expression: str, base_priority: int = 0):
+        super().__init__(expression, base_priority)
+        self.value = int(expression)
+
     def combine(self, d1: P_FIELD, d2: P_FIELD) -> P_FIELD:
         raise ValueError('Call to combine on dice cannot work')
 
     def _op(self, left: Number, right: Number) -> Number:
         raise ValueError("Call to _op done when should not have happened")
 
-    def run(self, add_msg_discord=None) -> ExecutionResult:
-        self.last_value = int(self.expression)
-        self._probas = {self.last_value: 1}
+    def cache_key(self) -> tuple | None:
+        return 'value', self.value
+
+    def postfix(self) -> list[Union[Node, STEP_T]]:
+        return [self._sampling_step()]
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        return np.full(n, self.value, dtype=np.int64)
+
+    def bounds(self) -> tuple[int, int]:
+        return self.value, self.value
+
+    def moments(self) -> Moments:
+        return self.value, 0.
+
+    def estimated_cost(self) -> int:
+        return 1
+
+    def run(self, context: EvalContext = None) -> ExecutionResult:
+        self.last_value = self.value
+        self._probas = Distribution.constant(self.last_value)
         self._solved = True
         return self.last_value, self._probas
 
@@ -313,12 +670,7 @@ class DiceNode(Node, command=r'\d*d\d+$'):
 
     def __init__(self, expression: str, base_priority: int = 0):
         super().__init__(expression, base_priority)
-        number, size = self.expression.split('d')
-        if not number:
-            number = "1"
-        self.number, self.size = int(number), int(size)
-        reduced = f'd{size}'
-        self._critical = reduced in CRITICAL_DICE_PERM or reduced in CRITICAL_DICE_TMP
+        self.number, self.size = parse_dice(expression)
 
     def combine(self, d1: P_FIELD, d2: P_FIELD) -> P_FIELD:
         raise ValueError('Call to combine on dice cannot work')
@@ -326,35 +678,65 @@ class DiceNode(Node, command=r'\d*d\d+$'):
     def _op(self, left: Number, right: Number) -> Number:
         raise ValueError("Call to _op done when should not have happened")
 
+    def cache_key(self) -> tuple | None:
+        return 'dice', self.number, self.size
+
+    def bounds(self) -> tuple[int, int]:
+        return self.number, self.number * self.size
+
+    def moments(self) -> Moments:
+        # the dice are independent, each of mean (M + 1) / 2 and variance (M² - 1) / 12
+        return self.number * (self.size + 1) / 2, self.number * (self.size ** 2 - 1) / 12
+
+    def estimated_cost(self) -> int:
+        # the dice are summed by repeated squaring, each convolution being at most as wide as the sum
+        return max(power_cost(self.size, self.number), 1)
+
     def _set_probas(self):
-        base_proba = {
-            i + 1: 1 / self.size
-            for i in range(self.size)
-        }
-        proba = {0: 1.}
-        for i in range(self.number):
-            proba = combine(base_proba, proba, lambda x, y: x + y)
-        self._probas = proba
-
-    def run(self, add_msg_discord=None) -> ExecutionResult:
+        self._probas = self._cached(lambda: Distribution.uniform(1, self.size).power(self.number))
+
+    def postfix(self) -> list[Union[Node, STEP_T]]:
+        return [self._sampling_step()]
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        if crits is None or not context.is_critical(self.size):
+            # the sum of the dice is all that matters,
+            # drawn from its distribution unless rolling the dice is cheaper than computing it
+            if self._probas is None and n * self.number <= self.estimated_cost():
+                return context.rng.integers(1, self.size + 1, (n, self.number)).sum(axis=1)
+            if self._probas is None:
+                self._set_probas()
+            return self._probas.sample(context.rng, n)
+        total = np.zeros(n, dtype=np.int64)
+        for _ in range(self.number):
+            rolls = context.rng.integers(1, self.size + 1, n)
+            total += rolls
+            crits['failures'] += rolls == 1
+            crits['successes'] += (rolls == self.size) & (rolls != 1)
+        return total
+
+    def run(self, context: EvalContext = None) -> ExecutionResult:
+        context = context or EvalContext()
         if self._probas is None:
             self._set_probas()
-        value = 0
-        for i in range(self.number):
-            value += (dice_roll := random.randint(1, self.size))
-            if self._critical and (dice_roll == 1 or dice_roll == self.size):
-                if dice_roll == 1:
-                    print(f"\033[33mDice {i} (of the {self.expression}) rolled a \033[31;1mNATURAL 1\033[33m "
-                          f"which is a critical failure\033[0m")
-                    if add_msg_discord is not None:
-                        add_msg_discord(f"Dice {i} (of the {self.expression}) rolled a **NATURAL 1** "
-                                        f"which is a **critical failure**")
-                elif dice_roll == self.size:
-                    print(f"\033[33mDice {i} (of the {self.expression}) rolled a "
-                          f"\033[32;1mNATURAL {self.size}\033[33m which is a critical success\033[0m")
-                    if add_msg_discord is not None:
-                        add_msg_discord(f"Dice {i} (of the {self.expression}) rolled a **NATURAL {self.size}** "
-                                        f"which is a **critical success**")
+        rolls = context.rng.integers(1, self.size + 1, self.number)
+        value = int(rolls.sum())
+        if context.is_critical(self.size):
+            for i in np.flatnonzero((rolls == 1) | (rolls == self.size)):
+                if rolls[i] == 1:
+                    context.announce(
+                        f"\033[33mDice {i} (of the {self.expression}) rolled a \033[31;1mNATURAL 1\033[33m "
+                        f"which is a critical failure\033[0m",
+                        f"Dice {i} (of the {self.expression}) rolled a **NATURAL 1** "
+                        f"which is a **critical failure**"
+                    )
+                else:
+                    context.announce(
+                        f"\033[33mDice {i} (of the {self.expression}) rolled a "
+                        f"\033[32;1mNATURAL {self.size}\033[33m which is a critical success\033[0m",
+                        f"Dice {i} (of the {self.expression}) rolled a **NATURAL {self.size}** "
+                        f"which is a **critical success**"
+                    )
         self.last_value = value
         self._solved = True
         return self.last_value, self._probas
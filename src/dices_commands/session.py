@@ -0,0 +1,107 @@
+# The following code was provided as part of a project.
+# As such, please refer to the project's LICENSE file.
+# If no such file was included, then no LICENSE was granted,
+# meaning that all usage was against the author's will.
+#
+# In applicable cases, the author reserves themself the right
+# to legally challenge any uses that are against their will,
+# or goes against the LICENSE.
+#
+# Only through a written agreement designating the user
+# (be it physical person or company) by name from the author
+# may the terms of the LICENSE, or lack thereof, be changed.
+#
+# Author: Alex SHP <alex.shp38540@gmail.com>
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from .cache import LRUCache
+from .distribution import Distribution
+
+RESULTS = LRUCache(max_size=4096, max_bytes=64 * 2 ** 20, sizeof=lambda d: d.nbytes)
+"""
+The distributions of the last rolls of the sessions, keyed by their digest.
+Sessions that rolled the same thing share it, and the oldest ones are forgotten past the limits.
+"""
+
+
+class Session:
+    """
+    What is remembered of a conversation (a discord channel) between two of its commands.
+
+    criticals: the dice that announce their criticals for the whole session.
+    epsilon: the probability its distributions may leave out of their tails, 0 for none (see EvalContext).
+    value: the last roll.
+    The distribution of the last roll is kept in RESULTS, the session only holds its digest.
+    """
+    __slots__ = ('criticals', 'epsilon', 'value', 'digest', 'last_used')
+
+    def __init__(self):
+        self.criticals: set[str] = set()
+        self.epsilon: float = 0.
+        self.value: Optional[int] = None
+        self.digest: Optional[str] = None
+        self.last_used: float = time.monotonic()
+
+    @property
+    def distribution(self) -> Optional[Distribution]:
+        """The distribution of the last roll, None if there was none or if it was forgotten since"""
+        if self.digest is None:
+            return None
+        return RESULTS.get(self.digest)
+
+    def remember(self, value: int, distribution: Distribution) -> None:
+        self.value = int(value)
+        self.digest = distribution.digest()
+        RESULTS.put(self.digest, distribution)
+
+
+class SessionStore:
+    """
+    The sessions, by key (a channel id), created on first use.
+
+    Parameters:
+    -----------
+    max_sessions: int
+        The maximal number of sessions, the least recently used ones are forgotten first.
+
+    ttl: float
+        The number of seconds after which an unused session is forgotten. None means never.
+    """
+
+    def __init__(self, max_sessions: int = 10_000, ttl: Optional[float] = 7 * 24 * 3600):
+        self._sessions: OrderedDict[Hashable, Session] = OrderedDict()
+        self._lock = threading.RLock()
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+
+    def get(self, key: Hashable) -> Session:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = Session()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(key)
+            session.last_used = now
+            return session
+
+    def _expire(self, now: float) -> None:
+        # the sessions are ordered by last use, the expired ones come first
+        while self.ttl is not None and self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.last_used <= self.ttl:
+                break
+            del self._sessions[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            self._expire(time.monotonic())
+            return key in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -8,7 +8,7 @@ import dices
 import fight_back
 import fight_funcs
 
-dices.verbose = False
+dices.set_verbose(False)
 
 
 def center(screen, string: str, cols: int, y: int, options: int = 1) -> None:
@@ -1,15 +1,23 @@
 import re
 import typing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
 import discord
 import dices
 import errors
 import sys
+from dices_commands.session import SessionStore
 
 call = typing.Callable[[str, ...], None]
 
 things_to_say: list[tuple[str, str]] = []
 
+POOLS: dict[str, type[Executor]] = {"processes": ProcessPoolExecutor, "threads": ThreadPoolExecutor}
+pool_kind: str = "processes"
+pool_workers: typing.Optional[int] = None  # as many as the machine can run at once
+roll_timeout: float = 30.
+executor: typing.Optional[Executor] = None  # computes the rolls, out of the event loop
+
 
 def say(thing: str) -> None:
     things_to_say.append((thing, ""))
@@ -20,19 +28,47 @@ def to(chan: str) -> None:
         things_to_say[-1] = things_to_say[-1][0], chan
 
 
+def pool(kind: str) -> None:
+    global pool_kind
+    if kind not in POOLS:
+        raise ValueError(f"Unknown pool {kind}, expected one of {list(POOLS)}")
+    pool_kind = kind
+
+
+def workers(number: str) -> None:
+    global pool_workers
+    pool_workers = int(number)
+
+
+def timeout(seconds: str) -> None:
+    global roll_timeout
+    roll_timeout = float(seconds)
+
+
+def graphs(directory: str) -> None:
+    dices.use_graph_directory(directory)
+
+
 intents = discord.Intents.default()
 intents.message_content = True
 
 
 client = discord.Client(intents=intents)
-d_probas: dict[int, dict] = {}
-d_value: dict[int, float] = {}
+sessions = SessionStore()  # by channel id
 
 say_command: list[str] = ["say", "--say", "-s", "tell", "write", "print"]
 to_command: list[str] = ["to", "--to", "-t", ]
+pool_command: list[str] = ["pool", "--pool", "-p"]
+workers_command: list[str] = ["workers", "--workers", "-w"]
+timeout_command: list[str] = ["timeout", "--timeout"]
+graphs_command: list[str] = ["graphs", "--graphs", "-g"]
 specific_command_types: list[typing.Union[list[tuple[call, int], str]]] = [
     [(say, 1)] + say_command,
-    [(to, 1)] + to_command
+    [(to, 1)] + to_command,
+    [(pool, 1)] + pool_command,
+    [(workers, 1)] + workers_command,
+    [(timeout, 1)] + timeout_command,
+    [(graphs, 1)] + graphs_command,
 ]
 
 commands: dict[str, tuple[call, int]] = {}
@@ -71,35 +107,20 @@ async def on_ready():
 async def on_message(message: discord.Message):
     # print(message.__class__.__name__, message.channel.__class__.__name__, (id := message.channel.id))
     chan_id = message.channel.id
-    global d_probas, d_value
     # quick and dirty way to ensure thatclient. context persists
     message_pile: list[str] = []
 
-    def pre_add_message(x: str, chan):
-        client.loop.create_task(chan.send(x))
-
     if message.author == client.user:
         return
     elif message.content.startswith("$"):
 
         try:
-            val = 0.
-            prob = {}
-            if chan_id in d_value:
-                val = d_value[chan_id]
-            if chan_id in d_probas:
-                prob = d_probas[chan_id]
             channel = message.channel
 
-            def add_message(x: str):
-                pre_add_message(x, channel)
-
-            answer, probas, value = await dices.discord_main(
-                message.content[1:], prob, val, to_send_to=add_message,
-                channel=channel
+            answer = await dices.discord_main(
+                message.content[1:], sessions.get(chan_id), to_send_to=message_pile.append,
+                channel=channel, executor=executor, timeout=roll_timeout
             )
-            d_value[chan_id] = value
-            d_probas[chan_id] = probas
         except errors.ShutDownCommand as er:
             await message.channel.send("GoodBye !")
             raise er
@@ -131,4 +152,9 @@ if __name__ == '__main__':
 
             pointer += cmd[1]
         pointer += 1
-    client.run(open("./key.key", "r").read())
+    executor = POOLS[pool_kind](pool_workers, initializer=dices.warm_up)
+    executor.submit(dices.warm_up)  # starts the workers now rather than on the first roll
+    try:
+        client.run(open("./key.key", "r").read())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
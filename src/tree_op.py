@@ -1,9 +1,14 @@
-import random
-import typing
+import copy
+import dataclasses
+import functools
+import math
 from abc import ABC
+from typing import Callable
 import numpy as np
-from dices_commands.node_actions import ExecutionResult, Number, P_FIELD, ValueNode, DiceNode
-from dices_commands.node_actions import Node, node, combine, PUBLISHER_T
+from dices_commands.node_actions import ExecutionResult, Number, P_FIELD, ValueNode, DiceNode, Moments
+from dices_commands.node_actions import Node, node, EvalContext, CRITS_T, STEP_T, Program, width
+from dices_commands import node_actions
+from dices_commands.distribution import Distribution
 
 
 ADVANTAGE_TOKEN = ["adv", "avantage", "av", "max"]
@@ -12,83 +17,162 @@ EMPHASIS_TOKEN = ["emph", "emphasis"]
 DROP_TOKEN = ["drop"]
 
 
-@node('+', priority_modifier=1)
+def sum_moments(left: Moments, right: Moments) -> Moments:
+    return left[0] + right[0], left[1] + right[1]
+
+
+def difference_moments(left: Moments, right: Moments) -> Moments:
+    return left[0] - right[0], left[1] + right[1]
+
+
+def product_moments(left: Moments, right: Moments) -> Moments:
+    # of independent sides, Var(XY) = Var(X)Var(Y) + Var(X)E(Y)² + Var(Y)E(X)²
+    (l_mean, l_var), (r_mean, r_var) = left, right
+    return l_mean * r_mean, l_var * r_var + l_var * r_mean ** 2 + r_var * l_mean ** 2
+
+
+@node('+', priority_modifier=1, distribution_op=Distribution.__add__, ufunc=np.add, moments_op=sum_moments)
 def add(x: int, y: int):
     return x + y
 
 
-@node('-', priority_modifier=1)
+@node('-', priority_modifier=1, distribution_op=Distribution.__sub__, ufunc=np.subtract, moments_op=difference_moments)
 def sub(x: int, y: int):
     return x - y
 
 
-@node('*', priority_modifier=3)
+@node('*', priority_modifier=3, ufunc=np.multiply, moments_op=product_moments)
 def mult(x: int, y: int):
     return x * y
 
 
-@node('/', priority_modifier=2)
+@node('/', priority_modifier=2, ufunc=np.floor_divide)
 def div(x: int, y: int):
     return x // y
 
 
-class AdvantageNode(Node, command='(?:' + '|'.join(ADVANTAGE_TOKEN) + ')$'):
+class AdvantageNode(Node, tokens=tuple(ADVANTAGE_TOKEN)):
+    ufunc = np.maximum
 
     def _op(self, left: Number, right: Number) -> Number:
         return max(left, right)
 
-    def _set_probas(self, l_prob: P_FIELD, r_prob: P_FIELD):
-        final = {}
-        for repet, p_repet in l_prob.items():
-            P = r_prob
-            for i in range(repet - 1):
-                P = self.combine(r_prob, P)
-            for result, p_result in P.items():
-                final[result] = final.get(result, 0) + p_result * p_repet
-        self._probas = final
+    def _set_probas(self, l_prob: P_FIELD, r_prob: P_FIELD, epsilon: float = 0.):
+        self._probas = self._cached(lambda: self._repeat(r_prob, l_prob), epsilon)
 
-    @staticmethod
-    def message_about(i: int, add_msg_discord: PUBLISHER_T = None) -> PUBLISHER_T | None:
-        if add_msg_discord is None:
+    def _repeat(self, r_prob: P_FIELD, repetitions: P_FIELD) -> P_FIELD:
+        """Distribution of the result when the right side is rolled a number of times following repetitions"""
+        return r_prob.max_of(repetitions)
+
+    def cache_key(self) -> tuple | None:
+        left = ('value', 2) if self.left_child is None else self.left_child.cache_key()
+        right = None if self.right_child is None else self.right_child.cache_key()
+        if left is None or right is None:
             return None
-        return lambda s: add_msg_discord(f'Concernant le lancé numéro {i}:\n' + s)
+        return self.__class__.__name__, left, right
+
+    def bounds(self) -> tuple[int, int]:
+        return self.right_child.bounds()
+
+    def estimated_cost(self) -> int:
+        # one row of probabilities per number of repetitions
+        left = (2, 2) if self.left_child is None else self.left_child.bounds()
+        return (
+            width(left) * width(self.right_child.bounds())
+            + (0 if self.left_child is None else self.left_child.estimated_cost())
+            + self.right_child.estimated_cost()
+        )
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        if self.left_child is None:
+            repetitions = np.full(n, 2)
+        else:
+            repetitions = self.left_child.sample(n, context, crits)
+        return self._repeated(repetitions, lambda: self.right_child.sample(n, context, crits))
+
+    def _repeated(self, repetitions: np.ndarray, roll: Callable[[], np.ndarray]) -> np.ndarray:
+        """Combines as many rolls of the right side as repetitions tells, roll drawing them"""
+        first_roll = roll()
+        result = first_roll
+        for i in range(1, max(int(repetitions.max()), 1)):
+            # the rolls that are not repeated that much are compared to their first roll instead
+            rolls = roll()
+            result = self._vectorized_op(result, np.where(i < repetitions, rolls, first_roll))
+        return result
+
+    def postfix(self) -> list[Node | STEP_T]:
+        # the right side is rolled again and again by a program of its own
+        right = Program(self.right_child)
+        repeated = self._repeated
+
+        def two(stack: list[np.ndarray], n: int, context: EvalContext, crits: CRITS_T) -> None:
+            stack.append(np.full(n, 2))
+
+        def step(stack: list[np.ndarray], n: int, context: EvalContext, crits: CRITS_T) -> None:
+            stack.append(repeated(stack.pop(), lambda: right.sample(n, context, crits)))
 
-    def run(self, add_msg_discord=None) -> ExecutionResult:
+        return [two if self.left_child is None else self.left_child, step]
+
+    @staticmethod
+    def message_about(i: int, context: EvalContext) -> EvalContext:
+        return context.about(f'Concernant le lancé numéro {i}:\n')
+
+    def run(self, context: EvalContext = None) -> ExecutionResult:
+        context = context or EvalContext()
         if self.left_child is None:
             repetitions = 2
-            l_probas = {2: 1.}
+            l_probas = Distribution.constant(2)
         else:
-            repetitions, l_probas = self.left_child.run(add_msg_discord)
-        first_roll, r_probas = self.right_child.run(add_msg_discord)
+            repetitions, l_probas = self.left_child.run(context)
+        first_roll, r_probas = self.right_child.run(context)
 
         if self._probas is None:
-            self._set_probas(l_probas, r_probas)
+            self._set_probas(l_probas, r_probas, context.epsilon)
 
-        self.last_value = self._op(
+        self.last_value = functools.reduce(self._op, [
             first_roll,
             *[
-                self.right_child.run(self.message_about(i + 1, add_msg_discord))[0]
+                self.right_child.run(self.message_about(i + 1, context))[0]
                 for i in range(int(repetitions - .5))
             ]
-        )
+        ])
 
         return self.last_value, self._probas
 
 
-class DisadvantageNode(AdvantageNode, command='(?:' + '|'.join(DISADVANTAGE_TOKEN) + ')$'):
+class DisadvantageNode(AdvantageNode, tokens=tuple(DISADVANTAGE_TOKEN)):
+    ufunc = np.minimum
 
     def _op(self, left: Number, right: Number) -> Number:
         return min(left, right)
 
+    def _repeat(self, r_prob: P_FIELD, repetitions: P_FIELD) -> P_FIELD:
+        return r_prob.min_of(repetitions)
+
+
+class EmphasisNode(AdvantageNode, tokens=tuple(EMPHASIS_TOKEN)):
+    ufunc = None
+    _estimated_mean: float | None = None
+
+    def estimated_cost(self) -> int:
+        # the rolls are combined pair by pair, a logarithmic number of times
+        left = (2, 2) if self.left_child is None else self.left_child.bounds()
+        return (
+            width(left) * width(self.right_child.bounds()) ** 2 * max(left[1].bit_length(), 1)
+            + (0 if self.left_child is None else self.left_child.estimated_cost())
+            + self.right_child.estimated_cost()
+        )
 
-class EmphasisNode(AdvantageNode, command='(?:' + '|'.join(EMPHASIS_TOKEN) + ')$'):
+    def _repeat(self, r_prob: P_FIELD, repetitions: P_FIELD) -> P_FIELD:
+        # no closed form here, the rolls are combined with each other
+        return Distribution.mixture(
+            (r_prob.power(max(repet, 1), self.combine), p_repet)
+            for repet, p_repet in repetitions.items()
+        )
 
     def _op(self, left: Number, right: Number) -> Number:
 
-        E = sum([
-            k * self.right_child._probas[k]
-            for k in self.right_child._probas
-        ]) if len(self.right_child._probas) > 0 else 0
+        E = self._expected_value()
 
         dl = left - E
         dr = right - E
@@ -97,8 +181,36 @@ class EmphasisNode(AdvantageNode, command='(?:' + '|'.join(EMPHASIS_TOKEN) + ')$
         else:
             return right
 
+    def _expected_value(self, context: EvalContext = None) -> float:
+        if self.right_child._probas is not None:
+            return self.right_child._probas.mean()
+        if self._estimated_mean is None:
+            context = context or EvalContext()
+            # the rolls are compared to the expected value of the right side,
+            # estimated by rolling it when its distribution is too costly
+            if self.right_child.estimated_cost() > node_actions.EXACT_BUDGET:
+                self._estimated_mean = float(
+                    self.right_child.sample(node_actions.MONTE_CARLO_SAMPLES, context).mean()
+                )
+            else:
+                self.right_child.run(dataclasses.replace(context, publisher=None, verbose=False))
+                return self.right_child._probas.mean()
+        return self._estimated_mean
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        self._expected_value(context)
+        return super().sample(n, context, crits)
+
+    def postfix(self) -> list[Node | STEP_T]:
+        expected_value = self._expected_value
 
-class SuperlativeNode(Node, command=r'(?:highest|lowest)\d+'):
+        def prepare(stack: list[np.ndarray], n: int, context: EvalContext, crits: CRITS_T) -> None:
+            expected_value(context)
+
+        return [prepare, *super().postfix()]
+
+
+class SuperlativeNode(Node, command=r'(?:highest|lowest)\d*$'):
     priority_modifier = 0
 
     def _op(self, left: Number, right: Number) -> Number:
@@ -111,11 +223,23 @@ class SuperlativeNode(Node, command=r'(?:highest|lowest)\d+'):
             self.last_value = 1
         else:
             self.last_value = int(number)
-            self._probas = {self.last_value: 1.}
+            self._probas = Distribution.constant(self.last_value)
         if self.expression.startswith('lowest'):
             self.last_value *= -1
 
-    def run(self, add_msg_discord: PUBLISHER_T = None) -> ExecutionResult:
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        return np.full(n, self.run()[0], dtype=np.int64)
+
+    def postfix(self) -> list[Node | STEP_T]:
+        return [self._sampling_step()]
+
+    def bounds(self) -> tuple[int, int]:
+        return self.run()[0], self.run()[0]
+
+    def estimated_cost(self) -> int:
+        return 1
+
+    def run(self, context: EvalContext = None) -> ExecutionResult:
         if self._probas is not None:
             return self.last_value, self._probas
         if isinstance(self.right_child, ValueNode):
@@ -124,7 +248,7 @@ class SuperlativeNode(Node, command=r'(?:highest|lowest)\d+'):
         return self.last_value, self._probas
 
 
-class DropNode(Node, command='(?:' + '|'.join(DROP_TOKEN) + ')$'):
+class DropNode(Node, tokens=tuple(DROP_TOKEN)):
     """
     Now, a drop command can be used in a few ways...
 
@@ -139,32 +263,71 @@ class DropNode(Node, command='(?:' + '|'.join(DROP_TOKEN) + ')$'):
     def _op(self, left: Number, right: Number) -> Number:
         return left
 
+    def cache_key(self) -> tuple | None:
+        if not isinstance(self.right_child, SuperlativeNode) or not isinstance(self.left_child, DiceNode):
+            return None
+        return (
+            'drop', self.left_child.number, self.left_child.size,
+            'lowest' if self.right_child.expression.startswith('lowest') else 'highest',
+            abs(self.right_child.last_value)
+        )
+
     def _set_probas(self, size, number, removed, lowest):
-        self._probas = {}
-        p_dict: P_FIELD = {
-            tuple(comb): 1 / (size ** number)
-            for comb in combinations(removed, size)
-        }
-        for combo in p_dict:
-            proba = p_dict[combo]
-            c: list[int] = list(combo)
-            for _ in range(removed):
-                if lowest:
-                    i = np.argmin(c)
-                else:
-                    i = np.argmax(c)
-                c = [C for j, C in enumerate(c) if j != i]
-            s = sum(c)
-            self._probas[s] = proba + self._probas.get(s, 0)
-
-    def run(self, add_msg_discord: PUBLISHER_T = None) -> ExecutionResult:
+        self._probas = self._cached(lambda: self._drop_distribution(size, number, removed, lowest))
+
+    @staticmethod
+    def _drop_distribution(size, number, removed, lowest) -> P_FIELD:
+        kept = number - min(max(removed, 0), number)
+        if kept == 0:
+            return Distribution.constant(0)
+        highest = keep_highest(number, size, kept)
+        if lowest:
+            return highest
+        # dropping the highest keeps the lowest, which are the highest of the dice read upside down
+        return Distribution(kept * (size + 1) - highest.max, highest.probs[::-1])
+
+    def _check_children(self):
         if not isinstance(self.right_child, SuperlativeNode):
             raise ValueError('Need to specify if we drop highest or lowest')
         if not isinstance(self.left_child, DiceNode):
             raise ValueError('Need to specify a dice roll to apply to this')
 
+    def bounds(self) -> tuple[int, int]:
+        self._check_children()
+        kept = self._kept()
+        return kept, kept * self.left_child.size
+
+    def estimated_cost(self) -> int:
+        self._check_children()
+        # keep_highest updates a row of kept * size + 1 probabilities at once, size * (number + 1) * (number + 2) / 2
+        # times: each update costs about as much as combining 140 pairs of values, and one more every 20 probabilities
+        number, size = self.left_child.number, self.left_child.size
+        return size * (number + 1) * (number + 2) // 2 * (140 + (self._kept() * size + 1) // 20)
+
+    def _kept(self) -> int:
+        return max(self.left_child.number - abs(self.right_child.run()[0]), 0)
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        self._check_children()
+        die: DiceNode = self.left_child
+        removed = min(abs(self.right_child.run()[0]), die.number)
+        rolls = np.sort(context.rng.integers(1, die.size + 1, (n, die.number)), axis=1)
+        if crits is not None and context.is_critical(die.size):
+            crits['failures'] += (rolls == 1).sum(axis=1)
+            crits['successes'] += ((rolls == die.size) & (rolls != 1)).sum(axis=1)
+        if self.right_child.expression.startswith('lowest'):
+            return rolls[:, removed:].sum(axis=1)
+        return rolls[:, :die.number - removed].sum(axis=1)
+
+    def postfix(self) -> list[Node | STEP_T]:
+        return [self._sampling_step()]
+
+    def run(self, context: EvalContext = None) -> ExecutionResult:
+        context = context or EvalContext()
+        self._check_children()
+
         lowest: bool = self.right_child.expression.startswith('lowest')
-        how_many_to_take: int = self.right_child.run()[0]
+        how_many_to_take: int = abs(self.right_child.run()[0])
         size: int = self.left_child.size
         how_many_to_roll: int = self.left_child.number
 
@@ -173,7 +336,7 @@ class DropNode(Node, command='(?:' + '|'.join(DROP_TOKEN) + ')$'):
             self._set_probas(size, how_many_to_roll, how_many_to_take, lowest)
 
         # and now we choose a value
-        r = random.random()
+        r = context.rng.random()
         sigma = 0
         for k in sorted(list(self._probas.keys())):
             sigma += self._probas[k]
@@ -183,41 +346,154 @@ class DropNode(Node, command='(?:' + '|'.join(DROP_TOKEN) + ')$'):
         return self.last_value, self._probas
 
 
-class CompNode(Node, ABC, command='$'):
+class CompNode(Node, ABC, command=None):
 
     priority_modifier = 8
+    _single: Node | None = None
 
-    def _compare_to_multi_dice_roll(self, dice_left):
-        dice: DiceNode = self.first_die_child()
+    def _compare_to_multi_dice_roll(self, dice_left, context: EvalContext):
+        """
+        Counts how many of the dice succeed, each die being compared on its own.
+
+        The count of successes follows a binomial law, whose probability of success
+        depends on the value compared to.
+        """
         if dice_left:
             dice_side = self.left_child
-            comp_to, comp_prob = self.right_child.run()
+            comp_to, comp_prob = self.right_child.run(context)
         else:
             dice_side = self.right_child
-            comp_to, comp_prob = self.left_child.run()
-        number = dice.number
-        # import traceback
-        # traceback.print_stack()
-        # print("Repeat", number)
-        dice.number = 1
-        dice._probas = None
-
-        rslt = 0
-        self._probas = None
-
-        for i in range(number):
-            result, probas = dice_side.run()
-            if dice_left:
-                rslt += self._op(result, comp_to)
-            else:
-                rslt += self._op(comp_to, result)
-            proba = self.combine(probas, comp_prob)
-            if self._probas is None:
-                self._probas = proba
-            self._probas = combine(self._probas, proba, lambda x, y: x + y)
-        self.last_value = rslt
-
-    def run(self, add_msg_discord: PUBLISHER_T = None) -> ExecutionResult:
+            comp_to, comp_prob = self.left_child.run(context)
+        number = dice_side.first_die_child().number
+        single = self._single_die(dice_side)
+        die = single.first_die_child()
+
+        if context.is_critical(die.size) and number > 0:
+            # every die has to be rolled to announce the criticals
+            results = [single.run(context)[0] for _ in range(number)]
+            single_prob = single.probas
+        else:
+            results = None
+            _, single_prob = single.run(context)
+
+        known = self._known_mass(single_prob, context)
+        p_success = self._success_probabilities(single_prob, comp_prob.support, dice_left, known)
+        # the rolls where a die fell in the pruned tails of single_prob are left out, not counted as failures
+        self._probas = self._cached(lambda: Distribution.mixture(
+            (Distribution.binomial(number, p), p_comp * known ** number)
+            for p, p_comp in zip(p_success, comp_prob.probs)
+            if p_comp > 0
+        ), context.epsilon)
+        if results is None:
+            self.last_value = int(context.rng.binomial(number, p_success[comp_to - comp_prob.offset]))
+        else:
+            self.last_value = sum(
+                self._op(result, comp_to) if dice_left else self._op(comp_to, result)
+                for result in results
+            )
+
+    def _single_die(self, dice_side: Node) -> Node:
+        """A copy of dice_side, where its die is only rolled once, made the first time it is needed"""
+        if self._single is None:
+            single = copy.deepcopy(dice_side)
+            die = single.first_die_child()
+            die.number, die._probas = 1, None
+            self._single = single
+        return self._single
+
+    def _multi_dice_side(self) -> Node | None:
+        """The side holding the only die of the comparison, if its dice are to be compared one by one"""
+        count_left_dice = self.left_child.count_dices_children()
+        if count_left_dice < 2 and count_left_dice + self.right_child.count_dices_children() == 1:
+            return self.left_child if count_left_dice == 1 else self.right_child
+        return None
+
+    def _copy(self) -> Node:
+        # the die rolled once is run along with the node
+        node = super()._copy()
+        if self._single is not None:
+            node._single = self._single.clone()
+        return node
+
+    def bounds(self) -> tuple[int, int]:
+        dice_side = self._multi_dice_side()
+        if dice_side is None:
+            return 0, 1
+        return 0, dice_side.first_die_child().number
+
+    def estimated_cost(self) -> int:
+        dice_side = self._multi_dice_side()
+        if dice_side is None:
+            return super().estimated_cost()
+        comp_side = self.right_child if dice_side is self.left_child else self.left_child
+        single = self._single_die(dice_side)
+        return (
+            (dice_side.first_die_child().number + 1) * width(comp_side.bounds())
+            + width(single.bounds()) * width(comp_side.bounds())
+            + single.estimated_cost()
+            + comp_side.estimated_cost()
+        )
+
+    def sample(self, n: int, context: EvalContext, crits: CRITS_T = None) -> np.ndarray:
+        count_left_dice = self.left_child.count_dices_children()
+        if count_left_dice < 2 and count_left_dice + self.right_child.count_dices_children() == 1:
+            dice_left = count_left_dice == 1
+            comp_to = (self.right_child if dice_left else self.left_child).sample(n, context, crits)
+            return self._sample_multi_dice_roll(comp_to, context, crits, dice_left)
+        return super().sample(n, context, crits)
+
+    def postfix(self) -> list[Node | STEP_T]:
+        dice_side = self._multi_dice_side()
+        if dice_side is None:
+            return super().postfix()
+        dice_left = dice_side is self.left_child
+        sample_multi_dice_roll = self._sample_multi_dice_roll
+
+        def step(stack: list[np.ndarray], n: int, context: EvalContext, crits: CRITS_T) -> None:
+            stack.append(sample_multi_dice_roll(stack.pop(), context, crits, dice_left))
+
+        return [self.right_child if dice_left else self.left_child, step]
+
+    def _sample_multi_dice_roll(self, comp_to: np.ndarray, context: EvalContext, crits: CRITS_T, dice_left: bool):
+        """Rolls the dice one by one against the n values of comp_to"""
+        n = len(comp_to)
+        dice_side = self.left_child if dice_left else self.right_child
+        number = dice_side.first_die_child().number
+        single = self._single_die(dice_side)
+        if crits is not None and context.is_critical(single.first_die_child().size):
+            successes = np.zeros(n, dtype=np.int64)
+            for _ in range(number):
+                rolls = single.sample(n, context, crits)
+                successes += self._vectorized_op(rolls, comp_to) if dice_left else self._vectorized_op(comp_to, rolls)
+            return successes
+        _, single_prob = single.run(dataclasses.replace(context, publisher=None, verbose=False))
+        lowest = comp_to.min()
+        p_success = self._success_probabilities(
+            single_prob, np.arange(lowest, comp_to.max() + 1), dice_left, self._known_mass(single_prob, context)
+        )
+        return context.rng.binomial(number, p_success[comp_to - lowest])
+
+    @staticmethod
+    def _known_mass(single_prob: P_FIELD, context: EvalContext) -> float:
+        """The probability that a single die falls within single_prob, less than 1 once pruned"""
+        return 1. - single_prob.missing_mass if context.epsilon > 0 else 1.
+
+    def _success_probabilities(
+            self, single_prob: P_FIELD, comp_values: np.ndarray, dice_left: bool, known: float = 1.
+    ) -> np.ndarray:
+        """
+        The probability that a single die succeeds, for each of the values it is compared to,
+        knowing that it falls within single_prob, which holds known of its mass.
+        """
+        operation = np.frompyfunc(self._op, 2, 1)
+        if dice_left:
+            successes = operation.outer(single_prob.support, comp_values)
+        else:
+            successes = operation.outer(comp_values, single_prob.support).T
+        return np.clip(single_prob.probs @ successes.astype(float) / known, 0., 1.)
+
+    def run(self, context: EvalContext = None) -> ExecutionResult:
+        context = context or EvalContext()
         count_left_dice = self.left_child.count_dices_children()
         dice_left = count_left_dice == 1
 
@@ -229,45 +505,70 @@ class CompNode(Node, ABC, command='$'):
         ):
             # only one die was rolled
 
-            self._compare_to_multi_dice_roll(dice_left)
+            self._compare_to_multi_dice_roll(dice_left, context)
             return self.last_value, self._probas
 
-        left_reslt, left_proba = self.left_child.run(add_msg_discord)
-        right_reslt, right_proba = self.right_child.run(add_msg_discord)
+        left_reslt, left_proba = self.left_child.run(context)
+        right_reslt, right_proba = self.right_child.run(context)
 
-        if self._probas:
-            self._probas = self.combine(left_proba, right_proba)
+        if self._probas is None:
+            self._probas = self._cached(
+                lambda: self.combine(left_proba, right_proba).prune(context.epsilon), context.epsilon
+            )
         self.last_value = int(self._op(left_reslt, right_reslt))
         return self.last_value, self._probas
 
 
-class GTNode(CompNode, command='>'):
+class GTNode(CompNode, tokens=('>',)):
+    ufunc = np.greater
+
     def _op(self, left: Number, right: Number) -> Number:
         return int(left > right)
 
 
-class LTNode(CompNode, command='<'):
+class LTNode(CompNode, tokens=('<',)):
+    ufunc = np.less
+
     def _op(self, left: Number, right: Number) -> Number:
         return int(left < right)
 
 
-class GENode(CompNode, command='>='):
+class GENode(CompNode, tokens=('>=',)):
+    ufunc = np.greater_equal
+
     def _op(self, left: Number, right: Number) -> Number:
         return int(left >= right)
 
 
-class LENode(CompNode, command='<='):
+class LENode(CompNode, tokens=('<=',)):
+    ufunc = np.less_equal
+
     def _op(self, left: Number, right: Number) -> Number:
         return int(left <= right)
 
 
-def combinations(n_iter: int, max_n: int, min_n: int = 1) -> typing.Iterable:
-    cur_list = [min_n] * n_iter
-    while cur_list[0] <= max_n:
-        yield cur_list
-        pointer = -1
-        cur_list[pointer] += 1
-        while cur_list[pointer] > max_n and pointer > -n_iter:
-            cur_list[pointer] = min_n
-            pointer -= 1
-            cur_list[pointer] += 1
+def keep_highest(number: int, size: int, kept: int) -> Distribution:
+    """
+    Distribution of the sum of the `kept` highest dice out of `number` dice of `size` sides.
+
+    The faces are looked at from the highest to the lowest, counting how many dice show each of them.
+    As long as fewer than `kept` dice were counted, the newly counted ones are kept.
+    This takes O(size * number² * kept * size) operations instead of enumerating the size ** number rolls.
+    """
+    # states[j, s]: probability that j dice were counted so far, the kept ones summing to s
+    states = np.zeros((number + 1, kept * size + 1))
+    states[0, 0] = 1.
+    for face in range(size, 0, -1):
+        new_states = np.zeros_like(states)
+        for counted in range(number + 1):
+            if not states[counted].any():
+                continue
+            left = number - counted
+            # every die left has to show a 1 once we get there
+            for count in ([left] if face == 1 else range(left + 1)):
+                weight = math.comb(left, count) / size ** count
+                shift = face * (min(counted + count, kept) - min(counted, kept))
+                new_states[counted + count, shift:] += weight * states[counted, :len(states[counted]) - shift]
+        states = new_states
+    # at least `kept` can be rolled, with only ones
+    return Distribution(kept, states[number, kept:])